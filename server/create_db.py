@@ -206,6 +206,8 @@ def build_database(path: str, admin_info: tuple=None) -> None:
                 'name TEXT NOT NULL, ' \
                 'value INTEGER DEFAULT NULL, ' \
                 'timestamp INTEGER)',
+            'CREATE UNIQUE INDEX idx_table_timeout_name_unique ON table_timeout(name)',
+            'CREATE UNIQUE INDEX idx_db_locks_name_unique ON db_locks(name)',
             'CREATE TABLE sparcd(version TEXT)'
         )
     version_stmt = f'INSERT INTO sparcd(version) VALUES({DB_VERSION})'
@@ -1,7 +1,6 @@
 """ Functions to handle basic requests for SPARCd server """
 
 from dataclasses import dataclass
-import hashlib
 import json
 import os
 from typing import Callable, Optional, Union
@@ -99,7 +98,6 @@ def __get_new_login(db: SPARCdDatabase, s3_info: S3Info, params: LoginParams,
 
     # Save information into the database - also cleans up old tokens if there's too many
     new_key = uuid.uuid4().hex
-    db.reconnect()
     db.add_token(token=new_key,
                  user=params.user,
                  password=crypt.do_encrypt(context.passcode, params.password),
@@ -151,14 +149,12 @@ def handle_login(db: SPARCdDatabase, passcode: str, expire_sec: int,
         A dict of the login results is returned upon success, and None is returned if there's a
         problem with the login information
     """
-    client_ip = request.environ.get('HTTP_X_FORWARDED_FOR', request.environ.get('HTTP_ORIGIN', \
-                                    request.environ.get('HTTP_REFERER',request.remote_addr) \
-                                    ))
+    client_ip = sdu.get_client_ip(request.environ)
     client_user_agent =  request.environ.get('HTTP_USER_AGENT', None)
     if not client_ip or client_ip is None or not client_user_agent or client_user_agent is None:
         return None
 
-    user_agent_hash = hashlib.sha256(client_user_agent.encode('utf-8')).hexdigest()
+    user_agent_hash = sdu.hash_user_agent(client_user_agent)
 
     params = __get_login_params()
 
@@ -185,7 +181,6 @@ def handle_login(db: SPARCdDatabase, passcode: str, expire_sec: int,
                     }
 
         # Delete the old token from the database
-        db.reconnect()
         db.remove_token(params.token)
 
     # Make sure we have the components we need for logging in
@@ -166,8 +166,7 @@ def __run_query(db: SPARCdDatabase, user_info: UserInfo, s3_info: S3Info,
     filter_colls = []
     for one_filter in context.filters:
         if one_filter[0] == 'collections':
-            filter_colls = filter_colls + \
-                                    [coll for coll in coll_info if coll['bucket'] in one_filter[1]]
+            filter_colls.extend(coll for coll in coll_info if coll['bucket'] in one_filter[1])
     if not filter_colls:
         filter_colls = coll_info
 
@@ -222,14 +221,11 @@ def handle_query(db: SPARCdDatabase, user_info: UserInfo, s3_info: S3Info, token
     results_id = uuid.uuid4().hex
     return_info = query_helpers.query_output(results, results_id)
 
-    # Check for old queries and clean them up
-    sdu.cleanup_old_queries(db, token)
-
-    # Save the query for lookup when downloading results
+    # Save the query for lookup when downloading results, and clean up any old queries
     save_path = os.path.join(tempfile.gettempdir(), SPARCD_PREFIX + 'query_' + \
                                                                 results_id + '.json')
     sdfu.save_timed_info(save_path, return_info)
-    db.save_query_path(token, save_path)
+    sdu.cleanup_old_queries(db, token, save_path)
 
     return return_info
 
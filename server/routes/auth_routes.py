@@ -1,7 +1,5 @@
 """ Authentication and session routes for SPARCd server """
 
-import hashlib
-
 from flask import Blueprint, jsonify, make_response, request, Response
 from flask_cors import cross_origin
 import requests
@@ -130,7 +128,7 @@ def image():
     if not client_user_agent:
         return 'Not Found', 404
 
-    user_agent_hash = hashlib.sha256(client_user_agent.encode('utf-8')).hexdigest()
+    user_agent_hash = sdu.hash_user_agent(client_user_agent)
 
     # Wildcard IP allows requests from any origin since images are loaded via browser tags
     token_valid, user_info = sdu.token_is_valid(token, '*', user_agent_hash, db,
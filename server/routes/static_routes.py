@@ -11,6 +11,7 @@ from sparcd_config import IMAGE_BROWSER_CACHE_TIMEOUT_SEC, \
                           LOGIN_PAGE_BROWSER_CACHE_TIMEOUT_SEC, REQEST_ALLOWED_FILE_EXTENSIONS, \
                           DEFAULT_TEMPLATE_PAGE, RESOURCE_START_PATH
 from sparcd_env import ALLOWED_ORIGINS
+import sparcd_utils as sdu
 
 static_bp = Blueprint('static', __name__)
 
@@ -20,9 +21,7 @@ static_bp = Blueprint('static', __name__)
 def index():
     """ Default page """
     print('RENDERING TEMPLATE', DEFAULT_TEMPLATE_PAGE, os.getcwd(), flush=True)
-    client_ip = request.environ.get('HTTP_X_FORWARDED_FOR',
-                    request.environ.get('HTTP_ORIGIN',
-                    request.environ.get('HTTP_REFERER', request.remote_addr)))
+    client_ip = sdu.get_client_ip(request.environ)
     client_user_agent = request.environ.get('HTTP_USER_AGENT', None)
     if not client_ip or not client_user_agent or client_user_agent == '-':
         return 'Resource not found', 404
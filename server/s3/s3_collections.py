@@ -5,6 +5,8 @@ import concurrent.futures
 import dataclasses
 from typing import Optional
 
+from minio import Minio
+
 from spd_types.s3info import S3Info
 from s3.s3_connect import s3_connect
 from s3.s3_access_helpers import (SPARCD_PREFIX, S3_UPLOADS_PATH_PART, COLLECTIONS_FOLDER,
@@ -126,12 +128,14 @@ class S3CollectionConnection:
 
     @staticmethod
     def list_uploads(conn_info: S3Info, bucket: str,
-                     extended_location: bool = False) -> Optional[tuple]:
+                     extended_location: bool = False, minio: Minio = None) -> Optional[tuple]:
         """ Returns the upload information for a collection
         Arguments:
             conn_info: the connection information for the S3 endpoint
             bucket: the bucket of the uploads
             extended_location: returns additional location information when set to True
+            minio: an existing S3 connection to use. Allows one connection to be shared when
+                   listing the uploads of many buckets
         Returns:
             Returns the uploads, or None
         """
@@ -141,7 +145,8 @@ class S3CollectionConnection:
 
         uploads_path = make_s3_path((COLLECTIONS_FOLDER, bucket[len(SPARCD_PREFIX):],
                                      S3_UPLOADS_PATH_PART)) + '/'
-        minio = s3_connect(conn_info)
+        if minio is None:
+            minio = s3_connect(conn_info)
         coll_uploads = []
 
         for one_obj in minio.list_objects(bucket, prefix=uploads_path):
@@ -199,7 +204,7 @@ class S3CollectionConnection:
                 for future in concurrent.futures.as_completed(cur_futures):
                     cur_incomplete = future.result()
                     if len(cur_incomplete) > 0:
-                        found_incomplete = found_incomplete + cur_incomplete
+                        found_incomplete.extend(cur_incomplete)
         else:
             found_incomplete = check_incomplete_thread(minio, buckets[0])
 
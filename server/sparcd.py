@@ -2,6 +2,9 @@
 """ This script contains the API for the SPARC'd server """
 
 import tempfile
+import threading
+import time
+import traceback
 
 from flask import Flask
 
@@ -20,6 +23,16 @@ from routes.species_routes import species_bp
 from routes.static_routes import static_bp
 from routes.upload_routes import upload_bp
 
+# Number of seconds between purges of expired tokens
+TOKEN_PURGE_INTERVAL_SEC = 60 * 60
+
+# Number of seconds between optimizing the databases
+DB_OPTIMIZE_INTERVAL_SEC = 15 * 60
+
+# Number of seconds before the next run that a periodic task's lock is free again, to allow for
+# the workers' timers drifting apart
+PERIODIC_LOCK_SLACK_SEC = 60
+
 
 def _reconcile_sandbox(db: SPARCdDatabase) -> None:
     """ Reconciles sandbox state at startup, completing interrupted uploads
@@ -63,6 +76,71 @@ def _reconcile_sandbox(db: SPARCdDatabase) -> None:
                            'normal')
 
 
+def _locked_periodic_run(lock_name: str, interval_sec: int, task) -> bool:
+    """ Runs a periodic task if no other server worker has run it during this interval
+    Arguments:
+        lock_name: the name of the database lock guarding the task
+        interval_sec: the number of seconds between runs of the task
+        task: the function to run, it's called with the database instance
+    Return:
+        Returns True if the task was run and False if another worker has it
+    Notes:
+        The lock is kept after a successful run so that the other workers skip the task until
+        the interval is nearly over. It's released if the task fails so that it can be retried
+    """
+    task_db = SPARCdDatabase(DEFAULT_DB_PATH, DEFAULT_DB_SANDBOX_PATH)
+    lock_id = task_db.get_lock(lock_name, max(interval_sec - PERIODIC_LOCK_SLACK_SEC, 1))
+    if lock_id is None:
+        return False
+
+    try:
+        task(task_db)
+    except Exception:
+        task_db.release_lock(lock_name, lock_id)
+        raise
+
+    return True
+
+
+def _purge_tokens_task(db: SPARCdDatabase) -> None:
+    """ Removes the expired tokens of all users
+    Arguments:
+        db: the database to purge
+    """
+    removed = db.purge_expired_tokens()
+    if removed:
+        print(f'INFO: purged {removed} expired tokens', flush=True)
+
+
+def _purge_expired_tokens() -> None:
+    """ Periodically removes expired tokens of all users. Tokens are otherwise only cleaned
+        up when their user logs in again
+    """
+    while True:
+        try:
+            _locked_periodic_run('purge_tokens', TOKEN_PURGE_INTERVAL_SEC, _purge_tokens_task)
+        except Exception as ex:  # pylint: disable=broad-exception-caught
+            print(f'Unable to purge expired tokens: {ex}', flush=True)
+            traceback.print_exception(ex)
+
+        time.sleep(TOKEN_PURGE_INTERVAL_SEC)
+
+
+def _optimize_databases() -> None:
+    """ Periodically refreshes the query planner statistics and checkpoints the WAL of the
+        databases so the WAL files don't keep growing under steady reads
+    """
+    while True:
+        time.sleep(DB_OPTIMIZE_INTERVAL_SEC)
+
+        try:
+            _locked_periodic_run('optimize_databases', DB_OPTIMIZE_INTERVAL_SEC,
+                                                                        SPARCdDatabase.optimize)
+        except Exception as ex:  # pylint: disable=broad-exception-caught
+            print(f'Unable to optimize the databases: {ex}', flush=True)
+            traceback.print_exception(ex)
+
+
 # Initialize server
 app = Flask(__name__)
 
@@ -79,8 +157,11 @@ app.config.from_object(__name__)
 _db = SPARCdDatabase(DEFAULT_DB_PATH, DEFAULT_DB_SANDBOX_PATH)
 _db.connect()
 _reconcile_sandbox(_db)     # Clean up the DB as needed
+_db.close()
 del _db
 _db = None
+threading.Thread(target=_purge_expired_tokens, daemon=True).start()
+threading.Thread(target=_optimize_databases, daemon=True).start()
 print(f'Using database at {DEFAULT_DB_PATH}, {DEFAULT_DB_SANDBOX_PATH}', flush=True)
 print(f'Temporary folder at {tempfile.gettempdir()}', flush=True)
 
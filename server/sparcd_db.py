@@ -1,10 +1,11 @@
 """This script contains the database interface for the SPARCd Web app
 """
 
-from contextlib import contextmanager
+from contextlib import closing, contextmanager
 import datetime
 import json
 import logging
+from operator import itemgetter
 import os
 from typing import Optional
 
@@ -34,16 +35,6 @@ class SPARCdDatabase:
         self._main_depth = 0
         self._sandbox_depth = 0
 
-    def __del__(self):
-        """Handles closing the connection and other cleanup
-        """
-        if self._db is not None:
-            del self._db
-            self._db = None
-        if self._sandbox_db is not None:
-            del self._sandbox_db
-            self._sandbox_db = None
-
     @contextmanager
     def _main(self):
         """ Context manager for main database
@@ -89,6 +80,12 @@ class SPARCdDatabase:
         """
         self.connect()
 
+    def close(self) -> None:
+        """Releases the connections to the databases
+        """
+        self._db.close()
+        self._sandbox_db.close()
+
     def add_token(self, token: str, user: str, password: str, client_ip: str,
                                 user_agent: str, s3_url: str, s3_id: str,
                                 token_timeout_sec: int=None) -> None:
@@ -112,6 +109,27 @@ class SPARCdDatabase:
 
             self._db.clean_expired_tokens(user, token_timeout_sec)
 
+    def purge_expired_tokens(self, token_timeout_sec: int=None) -> int:
+        """ Removes the expired tokens of all users
+        Arguments:
+            token_timeout_sec: timeout for cleaning up expired tokens from the table
+        Return:
+            Returns the number of tokens removed
+        """
+        if token_timeout_sec is None:
+            token_timeout_sec = SESSION_EXPIRE_SECONDS
+
+        with self._main():
+            return self._db.purge_expired_tokens(int(token_timeout_sec))
+
+    def optimize(self) -> None:
+        """ Performs periodic upkeep on the databases
+        """
+        with self._main():
+            self._db.optimize()
+        with self._sandbox():
+            self._sandbox_db.optimize()
+
     def update_token_timestamp(self, token: str) -> None:
         """Updates the token's timestamp to the database's now
         Arguments:
@@ -204,7 +222,7 @@ class SPARCdDatabase:
         with self._main():
             res = self._db.get_password(token)
 
-        if res and len(res) >= 1:
+        if res:
             return res[0]
 
         return ''
@@ -230,7 +248,7 @@ class SPARCdDatabase:
         with self._sandbox():
             indexes, res = self._sandbox_db.get_sandbox(s3_id)
 
-        if not res or len(res) < 1:
+        if not res:
             return tuple()
 
         return [{'user': row[indexes['user']],
@@ -256,11 +274,35 @@ class SPARCdDatabase:
         with self._main():
             res = self._db.get_uploads(s3_id, bucket, timeout_sec)
 
-        if not res or len(res) < 1:
+        if not res:
             return None
 
         return [{'name':row[0], 'json':row[1]} for row in res]
 
+    def get_uploads_bulk(self, s3_id: str, buckets: tuple, timeout_sec: int) -> dict:
+        """ Returns the uploads for multiple collections from the database
+        Arguments:
+            s3_id: the ID of the S3 instance
+            buckets: the buckets to get uploads for
+            timeout_sec: the amount of time before the table entries can be
+                         considered expired
+        Return:
+            Returns a dict keyed by bucket containing the list of upload names and data.
+            Buckets without unexpired uploads are not included in the dict
+        """
+        if not buckets:
+            return {}
+
+        with self._main():
+            res = self._db.get_uploads_bulk(s3_id, buckets, timeout_sec)
+
+        bucket_uploads = {}
+        for one_row in res:
+            bucket_uploads.setdefault(one_row[0], []).append({'name':one_row[1],
+                                                              'json':one_row[2]})
+
+        return bucket_uploads
+
     def save_uploads(self, s3_id: str, bucket: str, uploads: tuple) -> bool:
         """ Save the upload information into the table
         Arguments:
@@ -274,6 +316,21 @@ class SPARCdDatabase:
         with self._main():
             return self._db.save_uploads(s3_id, bucket, uploads)
 
+    def save_uploads_bulk(self, s3_id: str, bucket_uploads: tuple) -> bool:
+        """ Save the upload information of multiple buckets into the table
+        Arguments:
+            s3_id: the ID of the S3 instance
+            bucket_uploads: a tuple of bucket name and uploads pairs. The uploads are tuples of
+                the upload name and associated JSON
+        Return:
+            Returns True if the data was saved and False if something went wrong
+        """
+        if not bucket_uploads:
+            return True
+
+        with self._main():
+            return self._db.save_uploads_bulk(s3_id, bucket_uploads)
+
     def save_query_path(self, token: str, file_path: str) -> bool:
         """ Stores the specified query file path in the database
         Arguments:
@@ -285,6 +342,18 @@ class SPARCdDatabase:
         with self._main():
             return self._db.save_query_path(token, file_path)
 
+    def replace_query_path(self, token: str, file_path: str) -> tuple:
+        """ Stores the specified query file path in the database in place of any query paths
+            already associated with the token
+        Arguments:
+            token: a token associated with the path - can be used to manage paths
+            file_path: the path to the saved query information
+        Return:
+            Returns a tuple of the query paths that were replaced
+        """
+        with self._main():
+            return self._db.replace_query_path(token, file_path)
+
     def get_clear_queries(self, token: str) -> tuple:
         """ Returns a tuple of saved query paths associated with this token and removes
             them from the database
@@ -343,10 +412,10 @@ class SPARCdDatabase:
             # Get all the uploaded files (used to filter down remaining files which need uploading)
             res = self._sandbox_db.sandbox_get_upload_files(sandbox_id)
 
-        if not res or len(res) < 1:
+        if not res:
             return elapsed_sec, [], upload_id, old_upload_id
 
-        loaded_files = [row[0] for row in res]
+        loaded_files = list(map(itemgetter(0), res))
 
         return elapsed_sec, loaded_files, upload_id, old_upload_id
 
@@ -592,10 +661,10 @@ class SPARCdDatabase:
         with self._sandbox():
             res = self._sandbox_db.get_files_renamed(username, upload_id)
 
-        if not res or len(res) < 1:
+        if not res:
             return ()
 
-        return tuple((one_row[0], one_row[1]) for one_row in res)
+        return tuple(map(itemgetter(0, 1), res))
 
     def get_file_mimetypes(self, username: str, upload_id: str) -> Optional[tuple]:
         """ Returns the file paths and mimetypes for an upload
@@ -608,10 +677,10 @@ class SPARCdDatabase:
         with self._sandbox():
             res = self._sandbox_db.get_file_mimetypes(username, upload_id)
 
-        if not res or len(res) < 1:
+        if not res:
             return ()
 
-        return tuple((one_row[0], one_row[1]) for one_row in res)
+        return tuple(map(itemgetter(0, 1), res))
 
     def sandbox_file_processing_complete(self, file_id: int) -> None:
         """ Marks a file as being completely processed
@@ -632,10 +701,10 @@ class SPARCdDatabase:
         with self._sandbox():
             res = self._sandbox_db.get_file_created_timestamp(username, upload_id)
 
-        if not res or len(res) < 1:
+        if not res:
             return ()
 
-        return tuple((one_row[0], one_row[1]) for one_row in res)
+        return tuple(map(itemgetter(0, 1), res))
 
 
     def get_file_species(self, username: str, upload_id: str) -> Optional[tuple]:
@@ -647,20 +716,16 @@ class SPARCdDatabase:
             Returns a tuple containing a dict for each species entry of the upload. Each dict
             has the filename, timestamp, scientific name, count, common name, and location id
         """
-        with self._sandbox():
-            res = self._sandbox_db.get_file_species(username, upload_id)
-
-        if not res or len(res) < 1:
-            return ()
-
-        return tuple(
-                {'loc_id': one_row[0],
-                 'filename': one_row[1],
-                 'timestamp': one_row[2],
-                 'common': one_row[3],
-                 'scientific': one_row[4],
-                 'count': one_row[5]
-                } for one_row in res)
+        with self._sandbox(), closing(self._sandbox_db.get_file_species(username, upload_id)) \
+                                                                                    as species_rows:
+            return tuple(
+                    {'loc_id': one_row[0],
+                     'filename': one_row[1],
+                     'timestamp': one_row[2],
+                     'common': one_row[3],
+                     'scientific': one_row[4],
+                     'count': one_row[5]
+                    } for one_row in species_rows)
 
     def add_collection_edit(self, s3_id: str, bucket: str, upload_path: str, username: str, \
                                 timestamp: str, loc_id: str, loc_name: str, loc_ele: float) -> None:
@@ -721,19 +786,18 @@ class SPARCdDatabase:
             contains a dict with keys consisting of the file's S3 paths. The value associated with
             the file's paths is a tuple of tuples that contain the scientific name and the count
         """
-        with self._main():
-            res = self._db.get_image_species_edits(s3_id, bucket, upload_path)
+        file_species = {}
+        with self._main(), \
+                closing(self._db.get_image_species_edits(s3_id, bucket, upload_path)) as edit_rows:
+            for one_result in edit_rows:
+                if one_result[0] in file_species:
+                    file_species[one_result[0]].append(one_result[1:])
+                else:
+                    file_species[one_result[0]] = [one_result[1:]]
 
-        if not res or len(res) < 1:
+        if not file_species:
             return {bucket + ':' + upload_path:tuple()}
 
-        file_species = {}
-        for one_result in res:
-            if one_result[0] in file_species:
-                file_species[one_result[0]].append(one_result[1:])
-            else:
-                file_species[one_result[0]] = [one_result[1:]]
-
         return {bucket + ':' + upload_path:file_species}
 
     def have_upload_changes(self, s3_id: str, bucket: str, upload_name: str) -> bool:
@@ -858,19 +922,12 @@ class SPARCdDatabase:
             Returns a dict of 'locationsCount' and 'speciesCount'
         """
         with self._main():
-            res = self._db.admin_location_counts(s3_id, username)
-            if not res or len(res) <= 0:
-                locations_count = 0
-            else:
-                locations_count = res[0]
+            res = self._db.admin_counts(s3_id, username)
 
-            res = self._db.admin_species_counts(s3_id, username)
-            if not res or len(res) <= 0:
-                species_count = 0
-            else:
-                species_count = res[0]
+        if not res:
+            return {'locationsCount': 0, 'speciesCount': 0}
 
-        return {'locationsCount': locations_count, 'speciesCount': species_count}
+        return {'locationsCount': res[0] or 0, 'speciesCount': res[1] or 0}
 
     def clear_admin_location_changes(self, s3_id: str, username: str) -> None:
         """ Cleans up the administration location changes for this use
@@ -909,11 +966,13 @@ class SPARCdDatabase:
             Returns a tuple with the location edit's as a dict containing bucket, 
             base_path (on S3), loc_id, loc_name, loc_ele (with loc_ele containing the elevation).
             None is returned if there are no location changes to process
+        Notes:
+            The returned location edit is marked as updated when it's fetched
         """
         with self._main():
             res = self._db.get_next_upload_location(s3_id, username)
 
-        if not res or len(res) <= 0 or len(res) < 5:
+        if not res or len(res) < 5:
             return None
 
         return {'s3_url': s3_id, 'bucket':res[0], 'base_path':res[1], \
@@ -983,35 +1042,34 @@ class SPARCdDatabase:
             It's recommended that only one of the S3 path, or the upload ID, is specified, not both.
         """
         # pylint: disable=too-many-arguments, too-many-positional-arguments
-        with self._main():
-            res = self._db.get_next_files_info(s3_id, username, updated_value, s3_path, upload_id,
-                                                                            allow_smaller_values)
-
         res_dict = {}
-        for one_res in res:
-            # Check if we need to update a species or add a new one
-            if one_res[1] in res_dict:
-                cur_species = [one_species for one_species in res_dict[one_res[1]]['species'] if \
-                                                            one_species['scientific'] == one_res[3]]
-                if cur_species and len(cur_species) >= 1:
-                    cur_species[0]['count'] = one_res[4]
+        with self._main(), closing(self._db.get_next_files_info(s3_id, username, updated_value,
+                                            s3_path, upload_id, allow_smaller_values)) as res:
+            for one_res in res:
+                # Check if we need to update a species or add a new one
+                if one_res[1] in res_dict:
+                    cur_species = [one_species for one_species in \
+                                                                res_dict[one_res[1]]['species'] \
+                                                    if one_species['scientific'] == one_res[3]]
+                    if cur_species and len(cur_species) >= 1:
+                        cur_species[0]['count'] = one_res[4]
+                    else:
+                        res_dict[one_res[1]]['species'].append({'common':one_res[2],
+                                                               'scientific':one_res[3],
+                                                               'count':one_res[4],
+                                                             })
+                    res_dict[one_res[1]]['request_id'] = one_res[5]
                 else:
-                    res_dict[one_res[1]]['species'].append({'common':one_res[2],
-                                                           'scientific':one_res[3],
-                                                           'count':one_res[4],
-                                                         })
-                res_dict[one_res[1]]['request_id'] = one_res[5]
-            else:
-                res_dict[one_res[1]] = {'s3_url': s3_id,
-                                        'filename': os.path.basename(one_res[1]),
-                                        'bucket': one_res[0],
-                                        's3_path': one_res[1],
-                                        'species':[{'common':one_res[2],
-                                                    'scientific':one_res[3],
-                                                    'count':one_res[4],
-                                                  }],
-                                        'request_id': one_res[5],
-                                       }
+                    res_dict[one_res[1]] = {'s3_url': s3_id,
+                                            'filename': os.path.basename(one_res[1]),
+                                            'bucket': one_res[0],
+                                            's3_path': one_res[1],
+                                            'species':[{'common':one_res[2],
+                                                        'scientific':one_res[3],
+                                                        'count':one_res[4],
+                                                      }],
+                                            'request_id': one_res[5],
+                                           }
 
         return [one_item for _, one_item in res_dict.items()]
 
@@ -1078,23 +1136,25 @@ class SPARCdDatabase:
                 raise RuntimeError('Invalid timeout seconds parameter when getting all ' \
                                                             f'collections: {timeout_sec}') from ex
 
-        with self._main():
-            all_coll = self._db.get_collections(s3_id)
+        # Only the JSON is kept while the rows are checked, it's decoded once we know none of
+        # the collections have expired
+        all_coll_json = []
+        with self._main(), closing(self._db.get_collections(s3_id)) as coll_rows:
+            for one_coll in coll_rows:
+                try:
+                    if int(one_coll[2]) >= timeout_sec:
+                        return None
+                except ValueError:
+                    # We have a problem that indicates the DB might be corrupted
+                    print('Error: database returned an invalid timeout value when getting all ' \
+                                                                                    'collections')
+                    return None
+                all_coll_json.append(one_coll[1])
 
-        if not all_coll or len(all_coll) <= 0:
+        if not all_coll_json:
             return None
 
-        for one_coll in all_coll:
-            try:
-                if int(one_coll[2]) >= timeout_sec:
-                    return None
-            except ValueError:
-                # We have a problem that indicates the DB might be corrupted
-                print('Error: database returned an invalid timeout value when getting all ' \
-                                                                                    'collections')
-                return None
-
-        return [json.loads(one_coll[1]) for one_coll in all_coll]
+        return [json.loads(one_json) for one_json in all_coll_json]
 
     def save_all_collections(self, s3_id: str, collections: tuple) -> None:
         """ Saves/replaces the collections into the database under the indicated ID
@@ -1218,7 +1278,7 @@ class SPARCdDatabase:
         with self._main():
             upload_res = self._db.upload_get(s3_id, collection_id, upload_name)
 
-            if not upload_res or len(upload_res) <= 0:
+            if not upload_res:
                 return None
 
             try:
@@ -1267,7 +1327,7 @@ class SPARCdDatabase:
         with self._main():
             image_data = self._db.get_image_data(s3_id, collection_id, upload_name, image_key)
 
-        if not image_data or len(image_data) <= 0:
+        if not image_data:
             return None
 
         try:
@@ -1310,10 +1370,10 @@ class SPARCdDatabase:
             res = self._db.user_names(s3_id)
 
         # Make sure we have something to work with
-        if not res or len(res) <= 0:
+        if not res:
             return []
 
-        return [one_row[0] for one_row in res]
+        return list(map(itemgetter(0), res))
 
     def message_add(self, s3_id: str, sender: str, receiver: str, subject: str, message: str, \
                                                                             priority: str) -> None:
@@ -1354,7 +1414,7 @@ class SPARCdDatabase:
             indexes, res = self._db.messages_get(s3_id, receiver, admin)
 
         # Make sure we have something to work with
-        if not res or len(res) <= 0:
+        if not res:
             return messages
 
         for one_row in res:
@@ -1457,7 +1517,7 @@ class SPARCdDatabase:
         with self._sandbox():
             res = self._sandbox_db.sandbox_get_incomplete()
 
-        if not res or len(res) < 1:
+        if not res:
             return ()
 
         return tuple(res)
@@ -1,16 +1,22 @@
 """ Species statistics utilities for SPARCd server """
 
+from collections import Counter
 import concurrent.futures
 import json
 import os
+import re
+import sys
 import tempfile
 import time
 import traceback
 from typing import Optional
 
+from minio import Minio
+
 import sparcd_collections as sdc
 import sparcd_file_utils as sdfu
 from s3.s3_collections import S3CollectionConnection
+from s3.s3_connect import s3_connect
 from s3.s3_access_helpers import SPARCD_PREFIX
 from sparcd_constants import TEMP_SPECIES_STATS_FILE_NAME_POSTFIX, \
                              TEMP_SPECIES_STATS_FILE_TIMEOUT_SEC
@@ -33,100 +39,98 @@ MAX_STAT_FETCH_WAIT_SEC = 5 * 60
 STAT_FETCH_WAIT_INTERVAL_SEC = MAX_STAT_FETCH_WAIT_SEC / \
                                ((MAX_STAT_FETCH_TRIES + 1) * MAX_STAT_FETCH_TRIES / 2)
 
+# Maximum number of concurrent S3 upload fetches. The fetches share one Minio client, whose
+# default connection pool holds 10 connections per host
+MAX_UPLOAD_FETCH_WORKERS = 10
+
+# Matches a non-empty species list in an upload's JSON
+SPECIES_PRESENT_RE = re.compile(r'"species"\s*:\s*\[\s*\{')
 
-def list_uploads_thread(s3_info: S3Info, bucket: str) -> object:
+
+def list_uploads_thread(s3_info: S3Info, bucket: str, minio: Minio = None) -> object:
     """ Used to load upload information from an S3 instance
     Arguments:
         s3_info: the connection information for the S3 instance
         bucket: the bucket to look in
+        minio: optional shared S3 connection to use
     Return:
         Returns an object with the loaded uploads
     """
-    uploads_info = S3CollectionConnection.list_uploads(s3_info, bucket)
+    uploads_info = S3CollectionConnection.list_uploads(s3_info, bucket, minio=minio)
     return {'bucket': bucket, 'uploads_info': uploads_info}
 
 
-def __load_db_uploads(db: SPARCdDatabase, s3_id: str,
-                      colls: tuple, s3_uploads: list) -> list:
-    """ Loads upload data from the database for all collections
+def __tally_species(upload_info: dict, pair_counts: Counter) -> None:
+    """ Counts the species found in an upload's images
     Arguments:
-        db: the database connection
-        s3_id: the S3 instance ID
-        colls: the list of collections to load
-        s3_uploads: list to append bucket names to when DB data is missing
-    Return:
-        Returns the list of upload dicts loaded from the database
+        upload_info: the upload information containing the 'images'
+        pair_counts: the counter of (name, scientific name) pairs to update
     """
-    all_results = []
-    for one_coll in colls:
-        cur_bucket = one_coll['bucket']
-        uploads_info = db.get_uploads(s3_id, cur_bucket, TIMEOUT_UPLOADS_SEC)
-        if uploads_info:
-            all_results.extend([{'bucket': cur_bucket,
-                                  'name': one_upload['name'],
-                                  'info': json.loads(one_upload['json'])
-                                          if one_upload['json'] else {}}
-                                 for one_upload in uploads_info])
-        else:
-            s3_uploads.append(cur_bucket)
-    return all_results
+    # Species names repeat across many images, interning them lets the counter compare
+    # names by identity and keep a single copy of each name
+    pair_counts.update((sys.intern(species_name), one_species['scientificName'])
+                       for one_image in upload_info.get('images', [])
+                       for one_species in one_image.get('species', [])
+                       if (species_name := (one_species.get('name') or '').strip()))
 
 
-def __load_s3_uploads(db: SPARCdDatabase, s3_id: str,
-                      s3_info: S3Info, s3_uploads: list) -> list:
-    """ Loads upload data from S3 asynchronously for buckets missing from the database
+def __tally_db_uploads(bucket_uploads: dict, pair_counts: Counter) -> None:
+    """ Counts the species of the uploads loaded from the database
+    Arguments:
+        bucket_uploads: the uploads loaded from the database keyed by bucket
+        pair_counts: the counter of (name, scientific name) pairs to update
+    """
+    for uploads_info in bucket_uploads.values():
+        for one_upload in uploads_info:
+            # Scanning the text is much cheaper than decoding it, so only uploads with
+            # species in them get decoded
+            if one_upload['json'] and SPECIES_PRESENT_RE.search(one_upload['json']):
+                __tally_species(json.loads(one_upload['json']), pair_counts)
+
+
+def __tally_s3_uploads(db: SPARCdDatabase, s3_id: str, cur_futures: dict,
+                       pair_counts: Counter) -> None:
+    """ Counts the species of the uploads loaded from S3 for buckets missing from the database
+        as each fetch completes, and saves the uploads to the database
     Arguments:
         db: the database connection
         s3_id: the S3 instance ID
-        s3_info: the S3 connection information
-        s3_uploads: the list of bucket names to fetch from S3
-    Return:
-        Returns the list of upload dicts loaded from S3
+        cur_futures: the running S3 fetches keyed by future
+        pair_counts: the counter of (name, scientific name) pairs to update
     """
-    all_results = []
-    # TODO: Change this so that multiple calls get blocked until the first one succeeds
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        cur_futures = {executor.submit(list_uploads_thread, s3_info, bucket): bucket
-                       for bucket in s3_uploads}
-
-        for future in concurrent.futures.as_completed(cur_futures):
-            try:
-                uploads_results = future.result()
-                if not uploads_results.get('uploads_info'):
-                    continue
-                uploads_info = [{'bucket': uploads_results['bucket'],
-                                  'name': one_upload['name'],
-                                  'info': one_upload,
-                                  'json': json.dumps(one_upload)}
-                                 for one_upload in uploads_results['uploads_info']]
-                db.save_uploads(s3_id, uploads_results['bucket'], uploads_info)
-                all_results.extend(uploads_info)
-            except Exception as ex:  # pylint: disable=broad-exception-caught
-                print(f'Generated exception: {ex}', flush=True)
-                traceback.print_exception(ex)
-
-    return all_results
-
-
-def __count_species(all_results: list) -> dict:
-    """ Builds a species count dict from a list of upload results
+    save_uploads = []
+    for future in concurrent.futures.as_completed(cur_futures):
+        try:
+            uploads_results = future.result()
+            if not uploads_results.get('uploads_info'):
+                continue
+            save_uploads.append((uploads_results['bucket'],
+                                 [(one_upload['name'], json.dumps(one_upload))
+                                  for one_upload in uploads_results['uploads_info']]))
+            for one_upload in uploads_results['uploads_info']:
+                __tally_species(one_upload, pair_counts)
+        except Exception as ex:  # pylint: disable=broad-exception-caught
+            print(f'Generated exception: {ex}', flush=True)
+            traceback.print_exception(ex)
+
+    # Save all the fetched uploads at once
+    db.save_uploads_bulk(s3_id, save_uploads)
+
+
+def __make_species_stats(pair_counts: Counter) -> dict:
+    """ Builds a species count dict from the counted species
     Arguments:
-        all_results: the list of upload dicts each containing an 'info' dict with 'images'
+        pair_counts: the counts of (name, scientific name) pairs
     Return:
         Returns a dict keyed by species name containing count and scientificName
     """
+    # Fold the pairs into the per-name stats, keeping the first scientific name seen
     ret_stats = {}
-    for one_result in all_results:
-        for one_image in one_result.get('info', {}).get('images', []):
-            for one_species in one_image.get('species', []):
-                species_name = (one_species.get('name') or '').strip()
-                if not species_name:
-                    continue
-                if species_name in ret_stats:
-                    ret_stats[species_name]['count'] += 1
-                else:
-                    ret_stats[species_name] = {'count': 1,
-                                               'scientificName': one_species['scientificName']}
+    for (species_name, scientific_name), count in pair_counts.items():
+        if species_name in ret_stats:
+            ret_stats[species_name]['count'] += count
+        else:
+            ret_stats[species_name] = {'count': count, 'scientificName': scientific_name}
     return ret_stats
 
 
@@ -141,13 +145,29 @@ def species_stats(db: SPARCdDatabase, colls: tuple,
     Returns:
         Returns the species stats dict keyed by species name
     """
-    s3_uploads = []
-    all_results = __load_db_uploads(db, s3_id, colls, s3_uploads)
+    all_buckets = tuple(one_coll['bucket'] for one_coll in colls)
+    bucket_uploads = db.get_uploads_bulk(s3_id, all_buckets, TIMEOUT_UPLOADS_SEC)
+    s3_uploads = [one_bucket for one_bucket in all_buckets if not bucket_uploads.get(one_bucket)]
+
+    # Species are counted as each upload is loaded so the uploads aren't kept around
+    pair_counts = Counter()
+    if not s3_uploads:
+        __tally_db_uploads(bucket_uploads, pair_counts)
+        return __make_species_stats(pair_counts)
+
+    # Start fetching the missing buckets from S3 before parsing what the database returned.
+    # All the fetches share one connection so its connection pool is reused across buckets
+    # TODO: Change this so that multiple calls get blocked until the first one succeeds
+    minio = s3_connect(s3_info)
+    with concurrent.futures.ThreadPoolExecutor(
+                        max_workers=min(MAX_UPLOAD_FETCH_WORKERS, len(s3_uploads))) as executor:
+        cur_futures = {executor.submit(list_uploads_thread, s3_info, bucket, minio): bucket
+                       for bucket in s3_uploads}
 
-    if s3_uploads:
-        all_results.extend(__load_s3_uploads(db, s3_id, s3_info, s3_uploads))
+        __tally_db_uploads(bucket_uploads, pair_counts)
+        __tally_s3_uploads(db, s3_id, cur_futures, pair_counts)
 
-    return __count_species(all_results)
+    return __make_species_stats(pair_counts)
 
 
 def load_species_stats(db: SPARCdDatabase, is_admin: bool, s3_info: S3Info) -> Optional[tuple]:
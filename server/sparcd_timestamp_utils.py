@@ -2,6 +2,7 @@
 
 import calendar
 import concurrent.futures
+import functools
 import os
 import tempfile
 import time
@@ -20,6 +21,9 @@ from s3.s3_connect import s3_connect
 from s3.s3_uploads import S3UploadConnection
 from spd_types.s3info import S3Info
 
+# Maximum number of converted timezone offsets to keep around
+MAX_TZ_OFFSET_CACHE = 256
+
 
 @dataclass
 class TimestampAdjustContext:
@@ -54,6 +58,26 @@ def add_to_datetime(dt: datetime, ta: relativedelta) -> datetime:
     return result
 
 
+@functools.lru_cache(maxsize=MAX_TZ_OFFSET_CACHE)
+def __resolve_tz_offset(tz_offset: str) -> Optional[float]:
+    """ Converts a timezone offset or name to a numeric value
+    Arguments:
+        tz_offset: the number offset of the timezone in hours, or the timezone name
+                   (eg: "America/Phoenix")
+    Return:
+        Returns the timezone offset in hours, or None if the parameter can't be converted
+    """
+    try:
+        return int(tz_offset)
+    except ValueError:
+        pass
+
+    try:
+        return ZoneInfo(tz_offset).utcoffset(datetime(2025, 10, 9)).total_seconds() / 3600.0
+    except (ZoneInfoNotFoundError, ValueError):
+        return None
+
+
 def get_tz_offset(tz_offset: str) -> float:
     """ Converts a timezone offset or name to a numeric value. If the passed in parameter can't
         be converted, the local offset is used
@@ -64,19 +88,9 @@ def get_tz_offset(tz_offset: str) -> float:
         Returns the timezone offset in hours as a float
     """
     if tz_offset is not None:
-        try:
-            tz_offset = int(tz_offset)
-        except ValueError:
-            pass
-
-        if not isinstance(tz_offset, int):
-            try:
-                tz_offset = datetime(2025, 10, 9, 0, 0, 0, 0, ZoneInfo(tz_offset)).strftime('%z')
-                off_hours, off_min = divmod(int(tz_offset), 100.0)
-                tz_offset = off_hours + (off_min / 60)
-            except (ZoneInfoNotFoundError, ValueError):
-                tz_offset = None
+        tz_offset = __resolve_tz_offset(tz_offset)
 
+    # The local offset isn't cached since it changes with daylight savings
     if tz_offset is None:
         tz_offset = time.localtime().tm_gmtoff / (60.0 * 60.0)
 
@@ -249,13 +249,42 @@ def __process_upload_file(s3_info: S3Info, one_file: dict, idx: int,
     else:
         result = False, context.file_info_dict.get(file_key, one_file | {'species': []})
 
-    for cleanup_path in [save_path + '_original', save_path]:
-        if cleanup_path and os.path.exists(cleanup_path):
+    for cleanup_path in (save_path + '_original', save_path):
+        try:
             os.unlink(cleanup_path)
+        except FileNotFoundError:
+            pass
 
     return result
 
 
+def __remove_edit_folder(edit_folder: str) -> None:
+    """ Removes the edit folder and its files
+    Arguments:
+        edit_folder: the path of the folder to remove
+    Notes:
+        The edit folder only holds downloaded files so there's no need to walk a tree. Any
+        unexpected sub-folders are still removed. Removal problems are reported and not raised
+    """
+    with os.scandir(edit_folder) as folder_entries:
+        for one_entry in folder_entries:
+            try:
+                if one_entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(one_entry.path)
+                else:
+                    os.unlink(one_entry.path)
+            except OSError as ex:
+                print(f'Unable to remove edit file: {one_entry.path}', flush=True)
+                print(ex)
+
+    # A file that couldn't be removed leaves the folder behind, which isn't fatal
+    try:
+        os.rmdir(edit_folder)
+    except OSError as ex:
+        print(f'Unable to remove edit folder: {edit_folder}', flush=True)
+        print(ex)
+
+
 def process_upload_changes(s3_info: S3Info, params: UploadChangeParams) -> tuple:
     """ Updates the image files with the information passed in
     Argument:
@@ -284,6 +313,6 @@ def process_upload_changes(s3_info: S3Info, params: UploadChangeParams) -> tuple
             succeeded, result = __process_upload_file(s3_info, one_file, idx, context)
             (success_files if succeeded else failed_files).append(result)
     finally:
-        shutil.rmtree(context.edit_folder)
+        __remove_edit_folder(context.edit_folder)
 
     return success_files, failed_files
@@ -1,5 +1,6 @@
 """ Core utility functions for SPARCd server """
 
+import functools
 import hashlib
 import json
 import math
@@ -10,6 +11,12 @@ from flask import request
 
 from sparcd_db import SPARCdDatabase
 
+# Maximum number of distinct user agent hashes to keep around
+MAX_USER_AGENT_HASHES = 2048
+
+# Request environment key used to store the client IP once it's been determined
+CLIENT_IP_ENVIRON_KEY = '_sparcd_client_ip'
+
 
 def make_boolean(value) -> bool:
     """ Converts the parameter to a boolean value
@@ -88,13 +95,57 @@ def secure_user_settings(settings: dict) -> dict:
     return cur_settings
 
 
-def cleanup_old_queries(db: SPARCdDatabase, token: str) -> None:
+@functools.lru_cache(maxsize=MAX_USER_AGENT_HASHES)
+def hash_user_agent(user_agent: str) -> str:
+    """ Returns the hash of the user agent string
+    Arguments:
+        user_agent: the user agent to hash
+    Return:
+        The hex digest of the user agent hash
+    Notes:
+        There are relatively few distinct user agents making requests so the results are cached
+    """
+    return hashlib.sha256(user_agent.encode('utf-8')).hexdigest()
+
+
+def get_client_ip(environ: dict) -> Optional[str]:
+    """ Returns the client IP of the request
+    Arguments:
+        environ: the request environment
+    Return:
+        Returns the last address of any forwarded-for header, or the origin, referer, or
+        remote address of the request. None is returned if none of these are available
+    Notes:
+        The last forwarded-for address is the one added by our proxy. Earlier addresses are
+        supplied by the client and can't be trusted
+        The found client IP is stored in the request environment so that later calls for the
+        same request don't need to look it up again
+    """
+    if CLIENT_IP_ENVIRON_KEY in environ:
+        return environ[CLIENT_IP_ENVIRON_KEY]
+
+    forwarded_for = environ.get('HTTP_X_FORWARDED_FOR')
+    if forwarded_for:
+        client_ip = forwarded_for.rpartition(',')[2].strip()
+    else:
+        client_ip = environ.get('HTTP_ORIGIN') or environ.get('HTTP_REFERER') or \
+                                                                    environ.get('REMOTE_ADDR')
+
+    environ[CLIENT_IP_ENVIRON_KEY] = client_ip
+    return client_ip
+
+
+def cleanup_old_queries(db: SPARCdDatabase, token: str, new_query_path: str=None) -> None:
     """ Cleans up old queries off the file system
     Arguments:
         db: connections to the current database
         token: the session token used to identify queries to clean up
+        new_query_path: optional path of a new query to save in place of the old ones
     """
-    expired_queries = db.get_clear_queries(token)
+    if new_query_path:
+        expired_queries = db.replace_query_path(token, new_query_path)
+    else:
+        expired_queries = db.get_clear_queries(token)
     if expired_queries:
         for one_query_path in expired_queries:
             if os.path.exists(one_query_path):
@@ -120,14 +171,15 @@ def token_is_valid(token: str, client_ip: str, user_agent: str, db: SPARCdDataba
     """
     login_info, elapsed_sec = db.get_token_user_info(token)
     if login_info is not None and elapsed_sec is not None:
-        if login_info.settings:
-            login_info.settings = json.loads(login_info.settings)
-        if login_info.species:
-            login_info.species = json.loads(login_info.species)
-
         if abs(int(elapsed_sec)) < expire_seconds and \
            client_ip.rstrip('/') in (login_info.client_ip.rstrip('/'), '*') and \
            login_info.user_agent == user_agent:
+            # Only decode the user's JSON once we know the token is good
+            if login_info.settings:
+                login_info.settings = json.loads(login_info.settings)
+            if login_info.species:
+                login_info.species = json.loads(login_info.species)
+
             db.update_token_timestamp(token)
             return True, login_info
 
@@ -149,13 +201,12 @@ def token_user_valid(db: SPARCdDatabase, req, token: str, session_expire_sec: in
     if not db or not req or not token or not session_expire_sec:
         return None, None
 
-    client_ip = req.environ.get('HTTP_X_FORWARDED_FOR', req.environ.get('HTTP_ORIGIN',
-                                req.environ.get('HTTP_REFERER', req.remote_addr)))
+    client_ip = get_client_ip(req.environ)
     client_user_agent = req.environ.get('HTTP_USER_AGENT', None)
     if not client_ip or not client_user_agent:
         return None, None
 
-    user_agent_hash = hashlib.sha256(client_user_agent.encode('utf-8')).hexdigest()
+    user_agent_hash = hash_user_agent(client_user_agent)
     return token_is_valid(token, client_ip, user_agent_hash, db, session_expire_sec)
 
 
@@ -1,122 +1,219 @@
 """This script contains the SQLite database interface for the SPARCd Web app
 """
 
-from contextlib import contextmanager
 import datetime
+import functools
 import hashlib
-import logging
+import itertools
+from operator import itemgetter
 import sqlite3
-from time import sleep
-from typing import Generator, Optional
+import sys
+import threading
+from time import monotonic, time
+from typing import Callable, Iterator, Optional
+
+from spd_database.spdsqlite_base import SPDSQLiteBase
+
+# Maximum number of buckets bound into a single IN() query which keeps us under the SQLite
+# default limit of 999 bound parameters
+MAX_BUCKETS_PER_QUERY = 450
+
+# Maximum number of hashed strings to keep around
+MAX_HASH_CACHE = 4096
+# Maximum number of partially hashed prefixes (such as S3 IDs) to keep around
+MAX_HASH_PREFIX_CACHE = 64
+
+# Maximum number of IN() parameter placeholder strings to keep around
+MAX_SQL_PARAMS_CACHE = 64
+
+# Number of expired tokens removed in each purge transaction
+TOKEN_PURGE_BATCH_SIZE = 1000
+
+# Number of seconds a token's password is kept in memory after being looked up
+PASSWORD_CACHE_TTL_SEC = 30
+# Maximum number of token passwords kept in memory
+MAX_PASSWORD_CACHE = 10000
+
+# Range of code points reserved for UTF-16 surrogates, which aren't characters on their own
+_SURROGATE_FIRST = 0xD800
+_SURROGATE_LAST = 0xDFFF
+
+# Indexes for the lookups made on most requests
+MAIN_INDEXES = (
+    'CREATE INDEX IF NOT EXISTS idx_users_name_s3 ON users(name, s3_id)',
+    'CREATE INDEX IF NOT EXISTS idx_tokens_name_ts ON tokens(name, timestamp)',
+    'CREATE INDEX IF NOT EXISTS idx_tokens_ts ON tokens(timestamp)',
+    'CREATE INDEX IF NOT EXISTS idx_uploads_s3_bucket ON uploads(s3_id, bucket)',
+    'CREATE INDEX IF NOT EXISTS idx_upload_images_uploads_id ON upload_images(uploads_id)',
+    # Timeout entries are upserted by name, so any duplicates are removed before the name is
+    # made unique
+    'DELETE FROM table_timeout WHERE id NOT IN (SELECT MAX(id) FROM table_timeout GROUP BY name)',
+    'DROP INDEX IF EXISTS idx_table_timeout_name',
+    'CREATE UNIQUE INDEX IF NOT EXISTS idx_table_timeout_name_unique ON table_timeout(name)',
+    'DROP INDEX IF EXISTS idx_queries_token',
+    'CREATE INDEX IF NOT EXISTS idx_queries_token_ts ON queries(token, timestamp)',
+    # Locks are upserted by name as well
+    'DELETE FROM db_locks WHERE id NOT IN (SELECT MAX(id) FROM db_locks GROUP BY name)',
+    'DROP INDEX IF EXISTS idx_db_locks_name',
+    'CREATE UNIQUE INDEX IF NOT EXISTS idx_db_locks_name_unique ON db_locks(name)',
+    'CREATE INDEX IF NOT EXISTS idx_image_edits_lookup ON image_edits(s3_id, bucket, s3_file_path)',
+    # Pending edits are looked up and completed by user and updated state, which the wider
+    # indexes below cover
+    'DROP INDEX IF EXISTS idx_image_edits_user',
+    'CREATE INDEX IF NOT EXISTS idx_image_edits_user_updated ON ' \
+        'image_edits(s3_id, username, updated)',
+    'DROP INDEX IF EXISTS idx_collection_edits_user',
+    'CREATE INDEX IF NOT EXISTS idx_collection_edits_upload ON ' \
+        'collection_edits(s3_id, username, bucket, s3_base_path, updated)',
+    'CREATE INDEX IF NOT EXISTS idx_messages_receiver ON messages(s3_id, receiver)',
+    # Only the edits that haven't been applied yet are ever looked up, so these partial
+    # indexes stay small as the tables grow
+    'CREATE INDEX IF NOT EXISTS idx_collection_edits_open ON ' \
+        'collection_edits(s3_id, username) WHERE updated=0',
+    'DROP INDEX IF EXISTS idx_admin_location_edits_user',
+    'CREATE INDEX IF NOT EXISTS idx_admin_location_edits_open ON ' \
+        'admin_location_edits(user_id, s3_id, timestamp) WHERE location_updated=0',
+    'DROP INDEX IF EXISTS idx_admin_species_edits_user',
+    'CREATE INDEX IF NOT EXISTS idx_admin_species_edits_open ON ' \
+        'admin_species_edits(user_id, s3_id, timestamp) WHERE s3_updated=0',
+)
+
+# Triggers keeping dependent rows in step. SQLite can't add ON DELETE CASCADE to an existing
+# table, so removing an upload's images is done with a trigger instead
+MAIN_TRIGGERS = (
+    'CREATE TRIGGER IF NOT EXISTS trg_uploads_delete_images AFTER DELETE ON uploads ' \
+        'BEGIN DELETE FROM upload_images WHERE uploads_id=OLD.id; END',
+)
+
+# Recently looked up (encrypted) token passwords keyed by database path and token
+_PASSWORD_CACHE = {}
+_PASSWORD_CACHE_LOCK = threading.Lock()
+
+
+@functools.lru_cache(maxsize=MAX_HASH_PREFIX_CACHE)
+def _prefix_hash(prefix: str) -> 'hashlib._Hash':
+    """ Returns the hash object that has been updated with the prefix
+    Arguments:
+        prefix: the prefix to hash
+    Return:
+        The hash object. Callers need to copy() the returned object before updating it
+    """
+    return hashlib.md5(prefix.encode('utf-8'))
+
+
+@functools.lru_cache(maxsize=MAX_HASH_CACHE)
+def _hash2str(text: str, *more_text: str) -> str:
+    """ Returns the hash of the passed in strings joined together
+    Arguments:
+        text: the string to hash
+        more_text: any strings that follow the first one
+    Return:
+        The hash value as a string
+    Notes:
+        The same upload and collection keys get hashed several times while handling a request,
+        so the results are cached. When there's more than one string, the first one is
+        usually the S3 ID which rarely changes, so its partial hash is reused
+    """
+    if not more_text:
+        return hashlib.md5(text.encode('utf-8')).hexdigest()
 
-class SPDSQLite:
-    """Class handling access connections to the database
+    text_hash = _prefix_hash(text).copy()
+    for one_text in more_text:
+        text_hash.update(one_text.encode('utf-8'))
+    return text_hash.hexdigest()
+
+
+@functools.lru_cache(maxsize=MAX_SQL_PARAMS_CACHE)
+def _sql_params(count: int) -> str:
+    """ Returns the parameter placeholders for an IN() list
+    Arguments:
+        count: the number of parameters
+    Return:
+        The comma separated placeholders
     """
+    return ','.join('?' * count)
 
-    def __init__(self, db_path: str, logger: logging.Logger=None, verbose: bool=False):
-        """Initialize an instance
-        Arguments:
-            db_path: the path to the database file
-            logger: a logging instance
-            verbose: set to True to have more verbose logging
-        """
-        self._conn = None
-        self._path = db_path
-        self._verbose = verbose
-        self._logger = logger
-        self._savepoint_counter = 0
-
-    def __del__(self):
-        """Handles closing the connection and other cleanup
-        """
-        self.close()
-
-    @contextmanager
-    def transaction(self) -> Generator:
-        """Context manager for atomic database transactions
-        Yields:
-            The active database connection
-        Raises:
-            RuntimeError: If called before connecting to the database
-        Usage:
-            with self.transaction():
-                cursor.execute(...)
-                cursor.execute(...)
-        """
-        if self._conn is None:
-            raise RuntimeError('Attempting to start a transaction before connecting')
 
-        # Use a savepoint if a transaction is already active
-        in_transaction = self._conn.in_transaction
-        savepoint = None
+def _next_files_sql(check_smaller_values: bool, have_path: bool, have_upload: bool) -> str:
+    """ Returns the query used to get the file editing information
+    Arguments:
+        check_smaller_values: True if the updated value is an upper bound
+        have_path: True if the query is for a single S3 file path
+        have_upload: True if the query is for a single upload
+    Return:
+        The query string
+    """
+    return 'SELECT bucket, s3_file_path, obs_common, obs_scientific, obs_count, request_id ' \
+                    'FROM image_edits WHERE s3_id=? AND username=? ' + \
+                    ('AND updated<=? ' if check_smaller_values else 'AND updated=? ') + \
+                    ('AND s3_file_path=? ' if have_path else '') + \
+                    ('AND s3_file_path LIKE ? ' if have_upload else '') + \
+                    'ORDER BY obs_scientific ASC, edit_timestamp ASC'
+
+
+# All the variations of the file editing information query keyed by their flags
+NEXT_FILES_SQL = {flags: _next_files_sql(*flags) for flags in \
+                                        itertools.product((False, True), repeat=3)}
+
+
+def _prefix_end(prefix: str) -> Optional[str]:
+    """ Returns the smallest string that's greater than every string starting with the prefix
+    Arguments:
+        prefix: the prefix to get the end of
+    Return:
+        The string to use as the exclusive upper bound when searching for the prefix, or None
+        if there isn't an upper bound
+    Notes:
+        Trailing characters that can't be incremented are dropped, and the surrogate code
+        points are skipped since they can't be stored as text. Unlike LIKE, searching the
+        range is case-sensitive
+    """
+    prefix = prefix.rstrip(chr(sys.maxunicode))
+    if not prefix:
+        return None
+
+    next_char = ord(prefix[-1]) + 1
+    if _SURROGATE_FIRST <= next_char <= _SURROGATE_LAST:
+        next_char = _SURROGATE_LAST + 1
 
-        try:
-            if in_transaction:
-                self._savepoint_counter += 1
-                savepoint = f'sp_{self._savepoint_counter}'
-                self._conn.execute(f'SAVEPOINT {savepoint}')
-            yield self._conn
-            if in_transaction:
-                self._conn.execute(f'RELEASE SAVEPOINT {savepoint}')
-            else:
-                self._conn.commit()
-        except Exception:  # pylint: disable=broad-exception-caught
-            if in_transaction:
-                self._conn.execute(f'ROLLBACK TO SAVEPOINT {savepoint}')
-                self._conn.execute(f'RELEASE SAVEPOINT {savepoint}')
-            else:
-                self._conn.rollback()
-            raise
-
-    def hash2str(self, text: str) -> str:
-        """ Returns the hash of the passed in string
+    return prefix[:-1] + chr(next_char)
+
+
+class SPDSQLite(SPDSQLiteBase):
+    """Class handling access connections to the database
+    """
+
+    # Creates the indexes and triggers, and refreshes the statistics for the new indexes
+    SCHEMA_STATEMENTS = MAIN_INDEXES + MAIN_TRIGGERS + ('PRAGMA optimize',)
+
+    def hash2str(self, text: str, *more_text: str) -> str:
+        """ Returns the hash of the passed in strings joined together
         Arguments:
             text: the string to hash
+            more_text: any strings that follow the first one
         Return:
             The hash value as a string
         """
-        return hashlib.md5(text.encode('utf-8')).hexdigest()
+        return _hash2str(text, *more_text)
 
-    def database_info(self) -> tuple:
-        """ Returns information on the database as a tuple of strings
-        """
-        return (
-             'SQLite database',
-             f'Version: {sqlite3.sqlite_version}',
-             f'thread safety: {sqlite3.threadsafety}',
-             f'api level: {sqlite3.apilevel}',
-            )
-
-    def connect(self, database_path: str = None) -> None:
-        """Performs the actual connection to the database
+    def prefix_hasher(self, prefix: str) -> Callable[[str], str]:
+        """ Returns a function for hashing many strings that share the same prefix
         Arguments:
-            database: the database to connect to
-        """
-        database_path = database_path if database_path is not None else self._path
-        if self._conn is None:
-            if self._verbose:
-                print_params = \
-                    (param for param in (
-                        f'database={database_path}' if database_path is not None else None,
-                   ) if param is not None)
-                self._logger.info(f'Connecting to the database {print_params}')
-            # We disable thread checking since we're using thread-safe Sqlite
-            self._conn = sqlite3.connect(database_path, check_same_thread=False)
-            self._conn.execute('PRAGMA journal_mode=WAL')
-            self._conn.execute('PRAGMA busy_timeout=10000')
-
-    def reconnect(self) -> None:
-        """Attempts a reconnection if we're not connected
+            prefix: the common start of the strings to hash
+        Return:
+            A function returning the same value as hash2str(prefix + text) for its text parameter
+        Notes:
+            The prefix is only hashed once, and a copy of that hash is used for each string
         """
-        if self._conn is None:
-            self.connect()
+        prefix_hash = _prefix_hash(prefix)
 
-    def close(self) -> None:
-        """ Closes the connection to the database
-        """
-        if self._conn:
-            self._conn.close()
-            self._conn = None
+        def hash_suffix(text: str) -> str:
+            """ Returns the hash of the prefix followed by the text """
+            text_hash = prefix_hash.copy()
+            text_hash.update(text.encode('utf-8'))
+            return text_hash.hexdigest()
+
+        return hash_suffix
 
     def add_token(self, token: str, user: str, password: str, client_ip: str, user_agent: str, \
                                                             s3_url: str, s3_id: str) -> None:
@@ -136,12 +233,9 @@ class SPDSQLite:
             raise RuntimeError('Attempting to save tokens to the database before connecting')
 
         with self.transaction():
-            cursor = self._conn.cursor()
             query = 'INSERT INTO tokens(token, name, password, s3_url, s3_id, timestamp, ' \
                     'client_ip, user_agent) VALUES(?,?,?,?,?,strftime("%s", "now"),?, ?)'
-            cursor.execute(query, (token, user, password, s3_url, s3_id, client_ip, user_agent))
-
-            cursor.close()
+            self._conn.execute(query, (token, user, password, s3_url, s3_id, client_ip, user_agent))
 
     def clean_expired_tokens(self, user: str, token_timeout_sec: int) -> None:
         """ Cleans up expired tokens for the user
@@ -152,14 +246,37 @@ class SPDSQLite:
         if self._conn is None:
             raise RuntimeError('Attempting to clean up expired tokens from the database ' \
                                                                                 'before connecting')
+        # Comparing the timestamp column against a cutoff value lets the (name, timestamp)
+        # index be used for the range
         with self.transaction():
-            cursor = self._conn.cursor()
-            cursor.execute('DELETE FROM tokens WHERE tokens.id IN ' \
-                                '(SELECT id from tokens WHERE name=? AND ' \
-                                                    '(strftime("%s", "now")-timestamp) >= ?)',
-                        (user, token_timeout_sec))
+            self._conn.execute('DELETE FROM tokens WHERE name=? AND timestamp <= ?',
+                               (user, int(time()) - token_timeout_sec))
 
-            cursor.close()
+    def purge_expired_tokens(self, token_timeout_sec: int,
+                             batch_size: int=TOKEN_PURGE_BATCH_SIZE) -> int:
+        """ Removes the expired tokens of all users
+        Arguments:
+            token_timeout_sec: timeout for cleaning up expired tokens from the table
+            batch_size: the maximum number of tokens to remove in one transaction
+        Return:
+            Returns the number of tokens removed
+        Notes:
+            Each batch is committed separately so that the write lock isn't held for long
+        """
+        if self._conn is None:
+            raise RuntimeError('Attempting to purge expired tokens from the database ' \
+                                                                                'before connecting')
+        total_removed = 0
+        cutoff_ts = int(time()) - token_timeout_sec
+        while True:
+            with self.transaction():
+                cursor = self._conn.execute('DELETE FROM tokens WHERE id IN ' \
+                                    '(SELECT id FROM tokens WHERE timestamp <= ? LIMIT ?)',
+                                    (cutoff_ts, batch_size))
+                removed = cursor.rowcount
+            total_removed += removed
+            if removed < batch_size:
+                return total_removed
 
     def update_token_timestamp(self, token: str) -> None:
         """Updates the token's timestamp to the database's now
@@ -171,10 +288,8 @@ class SPDSQLite:
                                         'connecting')
 
         with self.transaction():
-            cursor = self._conn.cursor()
-            query = 'UPDATE tokens SET timestamp=strftime("%s", "now") WHERE token=?'
-            cursor.execute(query, (token,))
-            cursor.close()
+            self._conn.execute('UPDATE tokens SET timestamp=strftime("%s", "now") WHERE token=?',
+                                                                                        (token,))
 
     def remove_token(self, token: str) -> None:
         """ Attempts to remove the token from the database
@@ -184,10 +299,11 @@ class SPDSQLite:
         if self._conn is None:
             raise RuntimeError('remove_token: attempting to access database before connecting')
 
+        with _PASSWORD_CACHE_LOCK:
+            _PASSWORD_CACHE.pop((self._path, token), None)
+
         with self.transaction():
-            cursor = self._conn.cursor()
-            cursor.execute('DELETE FROM tokens WHERE token=(?)', (token,))
-            cursor.close()
+            self._conn.execute('DELETE FROM tokens WHERE token=(?)', (token,))
 
     def get_user_by_token(self, token: str) -> Optional[tuple]:
         """ Looks up token and user information
@@ -202,18 +318,12 @@ class SPDSQLite:
             raise RuntimeError('get_user_by_token: attempting to access database before ' \
                                     'connecting')
 
-        cursor = self._conn.cursor()
-        cursor.execute('WITH ti AS (SELECT token, name, s3_id, timestamp, client_ip, user_agent,' \
-                          '(strftime("%s", "now")-timestamp) AS elapsed_sec, s3_url FROM tokens ' \
-                          'WHERE token=?) '\
-                       'SELECT u.name, u.email, u.settings, u.species, u.administrator, ' \
-                          'ti.s3_url, ti.timestamp, ti.client_ip, ti.user_agent, ti.elapsed_sec ' \
-                          'FROM users u JOIN ti ON u.name = ti.name AND u.s3_id = ti.s3_id',
-                    (token,))
-        res = cursor.fetchone()
-        cursor.close()
-
-        return res
+        return self._conn.execute('SELECT u.name, u.email, u.settings, u.species, ' \
+                          'u.administrator, t.s3_url, t.timestamp, t.client_ip, t.user_agent, ' \
+                          '(?-t.timestamp) AS elapsed_sec ' \
+                       'FROM tokens t JOIN users u ON u.name = t.name AND u.s3_id = t.s3_id ' \
+                       'WHERE t.token=?',
+                    (int(time()), token)).fetchone()
 
     def get_user_by_name(self, s3_id: str, username: str) -> Optional[tuple]:
         """ Looks up the specified user
@@ -227,13 +337,9 @@ class SPDSQLite:
         if self._conn is None:
             raise RuntimeError('get_user: attempting to access database before connecting')
 
-        cursor = self._conn.cursor()
-        cursor.execute('SELECT name, email, settings, species, administrator FROM users ' \
-                                'WHERE name=? AND s3_id=?', (username, s3_id))
-        res = cursor.fetchone()
-        cursor.close()
-
-        return res
+        return self._conn.execute('SELECT name, email, settings, species, administrator ' \
+                                    'FROM users WHERE name=? AND s3_id=?',
+                                  (username, s3_id)).fetchone()
 
     def auto_add_user(self, s3_id: str, username: str, species: str, email: str=None) -> None:
         """ Add a user that doesn't exist. The user received default permissions as defined
@@ -249,10 +355,9 @@ class SPDSQLite:
 
         try:
             with self.transaction():
-                cursor = self._conn.cursor()
-                cursor.execute('INSERT INTO users(name, email, species, s3_id) VALUES(?, ?, ?, ?)',
+                self._conn.execute('INSERT INTO users(name, email, species, s3_id) ' \
+                                                                        'VALUES(?, ?, ?, ?)',
                                                             (username, email, species, s3_id))
-                cursor.close()
         except sqlite3.IntegrityError as ex:
             # If the user already exists, we ignore the error and continue
             if not ex.sqlite_errorcode == sqlite3.SQLITE_CONSTRAINT_UNIQUE:
@@ -264,15 +369,26 @@ class SPDSQLite:
             token: the token to lookup
         Return:
             Returns the fetched password in a tuple
+        Notes:
+            A token's password doesn't change so found passwords are kept for a short time to
+            save looking them up for each S3 call of a request
         """
         if self._conn is None:
             raise RuntimeError('Attempting to access database before connecting')
 
-        cursor = self._conn.cursor()
-        cursor.execute('SELECT password FROM tokens WHERE token=(?)', (token,))
+        cache_key = (self._path, token)
+        with _PASSWORD_CACHE_LOCK:
+            cached = _PASSWORD_CACHE.get(cache_key)
+        if cached is not None and cached[0] > monotonic():
+            return cached[1]
 
-        res = cursor.fetchone()
-        cursor.close()
+        res = self._conn.execute('SELECT password FROM tokens WHERE token=(?)',
+                                                                            (token,)).fetchone()
+        if res is not None:
+            with _PASSWORD_CACHE_LOCK:
+                if len(_PASSWORD_CACHE) >= MAX_PASSWORD_CACHE:
+                    _PASSWORD_CACHE.clear()
+                _PASSWORD_CACHE[cache_key] = (monotonic() + PASSWORD_CACHE_TTL_SEC, res)
 
         return res
 
@@ -289,30 +405,28 @@ class SPDSQLite:
                                     'connecting')
 
         with self.transaction():
-            cursor = self._conn.cursor()
-            cursor.execute('UPDATE users SET settings=?, email=? WHERE name=? and s3_id=?',
+            self._conn.execute('UPDATE users SET settings=?, email=? WHERE name=? and s3_id=?',
                                                                 (settings, email, username, s3_id))
-            cursor.close()
 
-    def get_collections(self, s3_id: str) -> tuple:
+    def get_collections(self, s3_id: str) -> Iterator[tuple]:
         """ Gets all the collections associated with the collection
         Arguments:
             s3_id: The ID of the S3 endpoint
         Return:
-            Returns the collection information as tuples. Each tuple is another tupple consisting
+            Returns an iterator over the collection information. Each row is a tuple consisting
             of the collection name, JSON, and elapsed_sec from when the entry was created
+        Notes:
+            The rows are fetched as they're iterated over, so they need to be consumed before
+            the connection is closed
         """
         if self._conn is None:
             raise RuntimeError('Attempting to get all collections from the database '\
                                                                                 'before connecting')
 
-        cursor = self._conn.cursor()
-        cursor.execute('SELECT coll_id, json, (strftime("%s", "now")-timestamp) AS elapsed_sec ' \
-                          'FROM collections WHERE s3_id=? ORDER BY NAME ASC', (s3_id,))
-        res = cursor.fetchall()
-        cursor.close()
-
-        return res
+        # The current time is bound once instead of having SQLite determine it for each row
+        return self._conn.execute('SELECT coll_id, json, (?-timestamp) AS elapsed_sec ' \
+                                    'FROM collections WHERE s3_id=? ORDER BY NAME ASC',
+                                  (int(time()), s3_id))
 
     def save_collections(self, s3_id: str, collections: tuple) -> bool:
         """ Saves the collections into the database
@@ -326,11 +440,14 @@ class SPDSQLite:
             raise RuntimeError('Attempting to save all collections into the database '\
                                                                                 'before connecting')
 
-        # Get the data into a tuple for quicker insert
+        # Get the data into a tuple for quicker insert. The timestamp is bound once instead of
+        # having SQLite determine it for each row
         insert_sql = 'INSERT INTO collections(s3_id, hash_id, name, coll_id, json, timestamp) ' \
-                                                    'VALUES(?, ?, ?, ?, ?, strftime("%s", "now"))'
-        insert_data = [(s3_id, self.hash2str(s3_id+one_coll['id']), one_coll['name'], \
-                                    one_coll['id'], one_coll['json']) for one_coll in collections]
+                                                                    'VALUES(?, ?, ?, ?, ?, ?)'
+        coll_hash = self.prefix_hasher(s3_id)
+        now_ts = int(time())
+        insert_data = [(s3_id, coll_hash(one_coll['id']), one_coll['name'], \
+                            one_coll['id'], one_coll['json'], now_ts) for one_coll in collections]
 
         # Run the queries
         try:
@@ -344,9 +461,8 @@ class SPDSQLite:
                 cursor.executemany(insert_sql, insert_data)
                 cursor.close()
         except sqlite3.Error as ex:
-            print(f'Save collections clearing sqlite error detected: {ex.sqlite_errorcode}')
-            print('    Not processing request further: delete')
-            print('   ',ex)
+            self._logger.warning('Save collections clearing sqlite error detected: %s: %s',
+                                                                        ex.sqlite_errorcode, ex)
             return False
 
         return True
@@ -364,21 +480,18 @@ class SPDSQLite:
             raise RuntimeError('Attempting to get collection timeout from the database before ' \
                                                                                     'connecting')
 
-        cursor = self._conn.cursor()
-        cursor.execute('SELECT (strftime("%s", "now")-timestamp) AS elapsed_sec FROM collections ' \
-                                    'WHERE hash_id=?', (self.hash2str(s3_id+coll_id),))
-
-        res = cursor.fetchone()
-        cursor.close()
+        res = self._conn.execute('SELECT (strftime("%s", "now")-timestamp) AS elapsed_sec ' \
+                                    'FROM collections WHERE hash_id=?',
+                                 (self.hash2str(s3_id, coll_id),)).fetchone()
 
-        if not res or len(res) < 1 or res[0] is None:
+        if not res or res[0] is None:
             return None
 
         try:
             return int(res[0])
         except ValueError:
-            print('Error: Invalid database value found when checking collection elapsed seconds: ' \
-                        f's3_id: {s3_id}')
+            self._logger.error('Invalid database value found when checking collection elapsed ' \
+                                                                        'seconds: s3_id: %s', s3_id)
             return None
 
     def collection_add(self, s3_id: str, coll_id: str, coll_name: str, coll_json: str) -> None:
@@ -394,12 +507,9 @@ class SPDSQLite:
                                                                             'before connecting')
 
         with self.transaction():
-            cursor = self._conn.cursor()
-            cursor.execute('INSERT INTO collections(s3_id, hash_id, name, coll_id, json, ' \
+            self._conn.execute('INSERT INTO collections(s3_id, hash_id, name, coll_id, json, ' \
                                 'timestamp) VALUES(?, ?, ?, ?, ?, strftime("%s", "now"))',
-                            (s3_id, self.hash2str(s3_id+coll_id), coll_name, coll_id, coll_json))
-
-            cursor.close()
+                            (s3_id, self.hash2str(s3_id, coll_id), coll_name, coll_id, coll_json))
 
     def collection_update(self, s3_id: str, coll_id: str, coll_json: str) -> None:
         """ Updates the database with the new collection information
@@ -413,12 +523,9 @@ class SPDSQLite:
                                                                             'before connecting')
 
         with self.transaction():
-            cursor = self._conn.cursor()
-            cursor.execute('UPDATE collections SET json=? WHERE s3_id=? AND coll_id=?',
+            self._conn.execute('UPDATE collections SET json=? WHERE s3_id=? AND coll_id=?',
                                                                         (coll_json, s3_id, coll_id))
 
-            cursor.close()
-
     def upload_save(self, s3_id: str, bucket: str, collection_id: str, upload_name: str, \
                                                                 upload_json: str) -> Optional[int]:
         """ Saves/replaces the image information associated with a particular collection's upload
@@ -435,30 +542,17 @@ class SPDSQLite:
             raise RuntimeError('Attempting to save an upload information into the database '\
                                                                                 'before connecting')
         # The ID that identifies this particular upload
-        hash_id = self.hash2str(s3_id+collection_id+upload_name)
-
-        # Get the upload ID(s) associated with this upload
-        cursor = self._conn.cursor()
-        cursor.execute('SELECT id FROM uploads WHERE hash_id=?', (hash_id,))
-        res = cursor.fetchall()
-        cursor.close()
+        hash_id = self.hash2str(s3_id, collection_id, upload_name)
 
-        upload_ids = [one_row[0] for one_row in res]
-
-        # First try to remove all the current upload entries
         last_row_id = None
         try:
             with self.transaction():
                 cursor = self._conn.cursor()
 
-                # First try to remove all the current upload entries
+                # Remove all the current upload entries, their images are removed by the
+                # uploads delete trigger
                 cursor.execute('DELETE FROM uploads WHERE hash_id=?', (hash_id,))
 
-                # Second, remove all images associated with this upload
-                if upload_ids:
-                    cursor.executemany('DELETE FROM upload_images WHERE uploads_id=?',
-                                                                [(uid,) for uid in upload_ids])
-
                 cursor.execute('INSERT INTO uploads(s3_id, bucket, hash_id, name, json, ' \
                                         'timestamp) VALUES(?, ?, ?, ?, ?, strftime("%s", "now"))',
                                         (s3_id, bucket, hash_id, upload_name, upload_json))
@@ -467,10 +561,8 @@ class SPDSQLite:
 
                 cursor.close()
         except sqlite3.Error as ex:
-            print('Save upload clearing sqlite error detected: ' \
-                                                                f'{ex.sqlite_errorcode}')
-            print('    Not processing request further: delete')
-            print('   ',ex)
+            self._logger.warning('Save upload clearing sqlite error detected: %s: %s',
+                                                                        ex.sqlite_errorcode, ex)
             return False
 
         return last_row_id
@@ -488,37 +580,28 @@ class SPDSQLite:
             raise RuntimeError('Attempting to get an upload information from the database '\
                                                                                 'before connecting')
 
-        # Get the cursor to work with
-        cursor = self._conn.cursor()
-        hash_id = self.hash2str(s3_id+collection_id+upload_name)
-
-        cursor.execute('SELECT id, json, (strftime("%s", "now")-timestamp) AS elapsed_sec FROM '\
-                                        'uploads WHERE hash_id=?', (hash_id,))
+        hash_id = self.hash2str(s3_id, collection_id, upload_name)
 
-        res = cursor.fetchone()
-        cursor.close()
+        return self._conn.execute('SELECT id, json, (strftime("%s", "now")-timestamp) AS ' \
+                                    'elapsed_sec FROM uploads WHERE hash_id=?',
+                                  (hash_id,)).fetchone()
 
-        return res
-
-    def upload_images_get(self, upload_id: int) -> tuple:
+    def upload_images_get(self, upload_id: int) -> Iterator[tuple]:
         """ Returns the images associated with the upload ID
         Arguments:
             upload_id: the ID associated with the image uploads
         Return:
-            Returns the images associated with the upload ID
+            Returns an iterator over the images associated with the upload ID
+        Notes:
+            The rows are fetched as they're iterated over, so they need to be consumed before
+            the connection is closed
         """
         if self._conn is None:
             raise RuntimeError('Attempting to get an upload\'s images from the database '\
                                                                                 'before connecting')
 
-        # Get the cursor to work with
-        cursor = self._conn.cursor()
-        cursor.execute('SELECT json FROM upload_images WHERE uploads_id=?', (upload_id,))
-
-        res = cursor.fetchall()
-        cursor.close()
-
-        return res
+        return self._conn.execute('SELECT json FROM upload_images WHERE uploads_id=?',
+                                                                                    (upload_id,))
 
     def upload_images_save(self, upload_id: int, images: tuple) -> bool:
         """ Saves the images associated with the upload ID
@@ -536,9 +619,11 @@ class SPDSQLite:
 
         # Prepare for the insert
         insert_query = 'INSERT INTO upload_images(uploads_id, hash_id, name, key, json, ' \
-                            'timestamp) VALUES(?, ?, ?, ?, ?, strftime("%s", "now"))'
-        insert_values = ([upload_id, self.hash2str(str(upload_id)+one_image['s3_path']), \
-                            one_image['name'], one_image['key'], one_image['json']] \
+                            'timestamp) VALUES(?, ?, ?, ?, ?, ?)'
+        image_hash = self.prefix_hasher(str(upload_id))
+        now_ts = int(time())
+        insert_values = ([upload_id, image_hash(one_image['s3_path']), \
+                            one_image['name'], one_image['key'], one_image['json'], now_ts] \
                                                                         for one_image in images)
 
         # Run the SQL
@@ -555,10 +640,8 @@ class SPDSQLite:
 
                 cursor.close()
         except sqlite3.Error as ex:
-            print('Save upload images clearing sqlite error detected: ' \
-                                                                f'{ex.sqlite_errorcode}')
-            print('    Not processing request further: delete')
-            print('   ',ex)
+            self._logger.warning('Save upload images clearing sqlite error detected: %s: %s',
+                                                                        ex.sqlite_errorcode, ex)
             return False
 
         return True
@@ -578,7 +661,7 @@ class SPDSQLite:
             raise RuntimeError('Attempting to get image information from the database before ' \
                                                                                     'connecting')
 
-        upload_hash_id = self.hash2str(s3_id+collection_id+upload_name)
+        upload_hash_id = self.hash2str(s3_id, collection_id, upload_name)
         cursor = self._conn.cursor()
         cursor.execute('WITH upl AS (SELECT id FROM uploads WHERE hash_id=? LIMIT 1) ' \
                         'SELECT json FROM upload_images, upl WHERE uploads_id=upl.id AND ' \
@@ -604,20 +687,46 @@ class SPDSQLite:
         if self._conn is None:
             raise RuntimeError('Attempting to access database before connecting')
 
-        # Check for expired collection uploads
-        cursor = self._conn.cursor()
-        cursor.execute('SELECT (strftime("%s", "now")-timestamp) AS elapsed_sec from ' \
-                       'table_timeout where name=(?) ORDER BY elapsed_sec DESC LIMIT 1', \
-                       (s3_id+bucket,))
+        # The uploads are only returned when the collection's oldest timeout entry hasn't
+        # expired. No rows are returned when there isn't a timeout entry
+        cutoff_ts = int(time()) - timeout_sec
+        return self._conn.execute('SELECT name,json FROM uploads WHERE s3_id=? AND bucket=? ' \
+                                    'AND (SELECT MIN(timestamp) FROM ' \
+                                            'table_timeout WHERE name=?) > ?',
+                                  (s3_id, bucket, s3_id+bucket, cutoff_ts)).fetchall()
 
-        res = cursor.fetchone()
-        if not res or len(res) < 1 or int(res[0]) >= timeout_sec:
-            cursor.close()
-            return None
+    def get_uploads_bulk(self, s3_id: str, buckets: tuple, timeout_sec: int) -> tuple:
+        """ Returns the uploads for multiple collections from the database
+        Arguments:
+            s3_id: the ID of the S3 instance endpoint
+            buckets: the buckets to get uploads for
+            timeout_sec: the amount of time before the table entries can be
+                         considered expired
+        Return:
+            Returns a tuple of row tuples containing the bucket, name, and json of the upload.
+            Buckets that have expired, or have no uploads, are not included
+        """
+        if self._conn is None:
+            raise RuntimeError('Attempting to access database before connecting')
+
+        res = []
+        cutoff_ts = int(time()) - timeout_sec
+        cursor = self._conn.cursor()
+        for idx in range(0, len(buckets), MAX_BUCKETS_PER_QUERY):
+            cur_buckets = tuple(buckets[idx:idx + MAX_BUCKETS_PER_QUERY])
+            bucket_params = _sql_params(len(cur_buckets))
+
+            # Only return uploads for buckets whose timeout entry hasn't expired. The bucket is
+            # split off the few timeout keys instead of building a key for every upload row
+            cursor.execute('SELECT bucket, name, json FROM uploads ' \
+                            'WHERE s3_id=? AND bucket IN ' \
+                                '(SELECT substr(name, ?) FROM table_timeout ' \
+                                    'WHERE name IN (' + bucket_params + ') AND timestamp > ?)',
+                            (s3_id, len(s3_id) + 1) + \
+                                tuple(s3_id + one_bucket for one_bucket in cur_buckets) + \
+                                (cutoff_ts,))
+            res.extend(cursor.fetchall())
 
-        cursor.execute('SELECT name,json FROM uploads WHERE s3_id=? AND bucket=?',
-                                                                                (s3_id, bucket))
-        res = cursor.fetchall()
         cursor.close()
 
         return res
@@ -632,51 +741,50 @@ class SPDSQLite:
         Return:
             Returns True if the data was saved and False if something went wrong
         """
+        return self.save_uploads_bulk(s3_id, ((bucket, tuple((one_upload['name'],
+                                                              one_upload['json'])
+                                                             for one_upload in uploads)),))
+
+    def save_uploads_bulk(self, s3_id: str, bucket_uploads: tuple) -> bool:
+        """ Save the upload information for multiple buckets into the table in one transaction
+        Arguments:
+            s3_id: the ID of the S3 instance endpoint
+            bucket_uploads: a tuple of bucket and uploads pairs. The uploads are tuples of the
+                upload name and associated JSON
+        Return:
+            Returns True if the data was saved and False if something went wrong
+        """
         if self._conn is None:
             raise RuntimeError('Attempting to access database before connecting')
 
+        now_ts = int(time())
         try:
             with self.transaction():
                 cursor = self._conn.cursor()
 
-                # Clean up old records
-                cursor.execute('DELETE FROM uploads where s3_id=? AND bucket=?', (s3_id, bucket))
+                for bucket, uploads in bucket_uploads:
+                    # Clean up old records
+                    cursor.execute('DELETE FROM uploads where s3_id=? AND bucket=?',
+                                                                                (s3_id, bucket))
+
+                    # Insert new records
+                    cursor.executemany('INSERT INTO uploads(s3_id, bucket, name, json, ' \
+                                            'timestamp) values(?, ?, ?, ?, ?)',
+                                    ((s3_id, bucket, upload_name, upload_json, now_ts)
+                                                    for upload_name, upload_json in uploads))
 
-                # Insert new records
-                for one_upload in uploads:
-                    cursor.execute('INSERT INTO uploads(s3_id, bucket, name, json, timestamp) ' \
-                                    'values(?, ?, ?, ?, strftime("%s", "now"))', \
-                                            (s3_id, bucket, one_upload['name'], one_upload['json']))
+                # Update the timeout table for uploads in the same transaction so the uploads
+                # and their timeouts are always in step
+                cursor.executemany('INSERT INTO table_timeout(name,timestamp) VALUES (?,?) ' \
+                                    'ON CONFLICT(name) DO UPDATE SET timestamp=excluded.timestamp',
+                                   ((s3_id+bucket, now_ts) for bucket, _ in bucket_uploads))
 
                 cursor.close()
         except sqlite3.Error as ex:
-            print(f'Save uploads delete sqlite error detected: {ex.sqlite_errorcode}')
-            print('    Not processing request further: delete')
-            print(ex)
+            self._logger.warning('Save uploads delete sqlite error detected: %s: %s',
+                                                                        ex.sqlite_errorcode, ex)
             return False
 
-        # Update the timeout table for uploads and do some cleanup if needed
-        cursor = self._conn.cursor()
-        cursor.execute('SELECT COUNT(1) FROM table_timeout WHERE name=(?)', (s3_id+bucket,))
-        res = cursor.fetchone()
-        cursor.close()
-
-        with self.transaction():
-            cursor = self._conn.cursor()
-            count = int(res[0]) if res and len(res) > 0 else 0
-            if count > 1:
-                # Remove multiple old entries
-                cursor.execute('DELETE FROM table_timeout WHERE name=(?)', (s3_id+bucket,))
-                count = 0
-            if count <= 0:
-                cursor.execute('INSERT INTO table_timeout(name,timestamp) ' \
-                                    'VALUES (?,strftime("%s", "now"))', (s3_id+bucket,))
-            else:
-                cursor.execute('UPDATE table_timeout SET timestamp=strftime("%s", "now") ' \
-                                    'WHERE name=(?)', (s3_id+bucket,))
-
-            cursor.close()
-
         return True
 
     def save_query_path(self, token: str, file_path: str) -> bool:
@@ -691,14 +799,36 @@ class SPDSQLite:
             raise RuntimeError('Attempting to save query paths in the database before connecting')
 
         # Check for expired collection uploads
+        with self.transaction():
+            self._conn.execute('INSERT INTO queries(token, path, timestamp) ' \
+                                'VALUES (?,?,strftime("%s", "now"))', (token, file_path))
+
+        return True
+
+    def replace_query_path(self, token: str, file_path: str) -> tuple:
+        """ Stores the specified query file path in the database in place of any query paths
+            already associated with the token
+        Arguments:
+            token: a token associated with the path - can be used to manage paths
+            file_path: the path to the saved query information
+        Return:
+            Returns a tuple of the query paths that were replaced
+        """
+        if self._conn is None:
+            raise RuntimeError('Attempting to save query paths in the database before connecting')
+
+        # Swap the paths in one transaction so there's only one commit
         with self.transaction():
             cursor = self._conn.cursor()
+            cursor.execute('DELETE FROM queries WHERE token=? RETURNING path', (token,))
+            return_paths = tuple(map(itemgetter(0), cursor.fetchall()))
+
             cursor.execute('INSERT INTO queries(token, path, timestamp) ' \
                                 'VALUES (?,?,strftime("%s", "now"))', (token, file_path))
 
             cursor.close()
 
-        return True
+        return return_paths
 
     def get_clear_queries(self, token: str) -> tuple:
         """ Returns a tuple of saved query paths associated with this token and removes
@@ -709,31 +839,18 @@ class SPDSQLite:
         if self._conn is None:
             raise RuntimeError('Attempting to save query paths in the database before connecting')
 
-        # Check for queries associated with the token
-        cursor = self._conn.cursor()
-        cursor.execute('SELECT id, path FROM queries WHERE token=(?)', (token,))
-
-        res = cursor.fetchall()
-        cursor.close()
-
-        if not res or len(res) < 1:
-            return []
-
-        path_ids = [row[0] for row in res]
-        return_paths = [row[1] for row in res]
-
-        # Clean up the queries
+        # Remove the queries associated with the token, getting their paths back
         try:
             with self.transaction():
                 cursor = self._conn.cursor()
-                cursor.execute('DELETE FROM queries where id in (' + \
-                                                    ','.join(['?'] * len(path_ids)) + ')', path_ids)
+                cursor.execute('DELETE FROM queries WHERE token=? RETURNING path', (token,))
+                return_paths = list(map(itemgetter(0), cursor.fetchall()))
                 cursor.close()
         except sqlite3.Error as ex:
-            print(f'Saved queries delete sqlite error detected: {ex.sqlite_errorcode}')
-            print('    Not processing request further: delete')
-            print('   ',ex)
+            self._logger.warning('Saved queries delete sqlite error detected: %s: %s',
+                                                                        ex.sqlite_errorcode, ex)
             # We give up for now and don't do anything
+            return []
 
         return return_paths
 
@@ -747,15 +864,11 @@ class SPDSQLite:
         if self._conn is None:
             raise RuntimeError('Attempting to save query paths in the database before connecting')
 
-        # Check for queries associated with the token
-        cursor = self._conn.cursor()
-        cursor.execute('SELECT path,(strftime("%s", "now")-timestamp) AS elapsed_sec FROM queries '\
-                                    'WHERE token=(?) ORDER BY elapsed_sec DESC LIMIT 1', (token,))
-
-        res = cursor.fetchone()
-        cursor.close()
-
-        return res
+        # Get the oldest query associated with the token, ordering on the stored column lets the
+        # index be used instead of sorting
+        return self._conn.execute('SELECT path,(strftime("%s", "now")-timestamp) AS elapsed_sec ' \
+                                    'FROM queries WHERE token=? ORDER BY timestamp ASC LIMIT 1',
+                                  (token,)).fetchone()
 
     def add_collection_edit(self, s3_id: str, bucket: str, upload_path: str, username: str, \
                                 timestamp: str, loc_id: str, loc_name: str, loc_ele: float) -> None:
@@ -777,16 +890,14 @@ class SPDSQLite:
 
         # Add the entry to the database
         with self.transaction():
-            cursor = self._conn.cursor()
-            cursor.execute('INSERT INTO collection_edits(s3_id, bucket, s3_base_path, username, ' \
+            self._conn.execute('INSERT INTO collection_edits(s3_id, bucket, s3_base_path, ' \
+                                                    'username, ' \
                                                     'edit_timestamp, loc_id, loc_name, loc_ele, ' \
                                                     'timestamp) '\
                                     'VALUES(?,?,?,?,?,?,?,?,strftime("%s", "now"))', 
                             (s3_id, bucket, upload_path, username, timestamp, loc_id, \
                                                                                 loc_name, loc_ele))
 
-            cursor.close()
-
     def add_image_species_edit(self, s3_id: str, bucket: str, file_path: str, username: str, \
                                 timestamp: str, common: str, species: str, count: str,
                                 request_id: str) -> None:
@@ -809,16 +920,13 @@ class SPDSQLite:
 
         # Add the entry to the database
         with self.transaction():
-            cursor = self._conn.cursor()
-            cursor.execute('INSERT INTO image_edits(s3_id, bucket, s3_file_path, username, ' \
+            self._conn.execute('INSERT INTO image_edits(s3_id, bucket, s3_file_path, username, ' \
                                         'edit_timestamp, obs_common, obs_scientific, obs_count,' \
                                         ' request_id, timestamp) '\
                                     'VALUES(?,?,?,?,?,?,?,?,?, strftime("%s", "now"))', 
                                 (s3_id, bucket, file_path, username, timestamp, common, \
                                                                     species, count, request_id))
 
-            cursor.close()
-
     def save_user_species(self, s3_id: str, username: str, species: str) -> None:
         """ Saves the species entry for the user
         Arguments:
@@ -832,37 +940,42 @@ class SPDSQLite:
 
         # Add the entry to the database
         with self.transaction():
-            cursor = self._conn.cursor()
-            cursor.execute('UPDATE users SET species=? WHERE name=? AND s3_id=?',
+            self._conn.execute('UPDATE users SET species=? WHERE name=? AND s3_id=?',
                                                                         (species, username, s3_id))
 
-            cursor.close()
-
-    def get_image_species_edits(self, s3_id: str, bucket: str, upload_path: str) -> dict:
+    def get_image_species_edits(self, s3_id: str, bucket: str, upload_path: str) -> \
+                                                                                Iterator[tuple]:
         """ Returns all the saved edits for this bucket and upload path
         Arguments:
             s3_id: the ID to the S3 instance
             bucket: the S3 bucket the collection is in
             upload_path: the upload name
         Return:
-            Returns a tuple containing the row tuples of the s3 file path, observation scientific
+            Returns an iterator over the row tuples of the s3 file path, observation scientific
             name, and the observation count
+        Notes:
+            The rows are fetched as they're iterated over, so they need to be consumed before
+            the connection is closed. The upload path is matched case-sensitively, the same as
+            S3 treats its paths, instead of ignoring ASCII case like a LIKE pattern does
         """
         if self._conn is None:
             raise RuntimeError('Attempting to fetch image species edits from the database '\
                                                                                 'before connecting')
 
-        # Get the edits
-        cursor = self._conn.cursor()
-        cursor.execute('SELECT s3_file_path, obs_scientific, obs_count FROM image_edits WHERE ' \
-                                    's3_id=? AND bucket=? AND s3_file_path like ? ' \
-                                'ORDER BY edit_timestamp ASC',
-                            (s3_id, bucket, upload_path+'%'))
-
-        res = cursor.fetchall()
-        cursor.close()
-
-        return res
+        # Get the edits. The path prefix is searched as a range so that the index can be used
+        path_end = _prefix_end(upload_path)
+        if path_end is None:
+            return self._conn.execute('SELECT s3_file_path, obs_scientific, obs_count ' \
+                                        'FROM image_edits WHERE s3_id=? AND bucket=? AND ' \
+                                            's3_file_path >= ? ' \
+                                        'ORDER BY edit_timestamp ASC',
+                                      (s3_id, bucket, upload_path))
+
+        return self._conn.execute('SELECT s3_file_path, obs_scientific, obs_count ' \
+                                    'FROM image_edits WHERE s3_id=? AND bucket=? AND ' \
+                                        's3_file_path >= ? AND s3_file_path < ? ' \
+                                    'ORDER BY edit_timestamp ASC',
+                                  (s3_id, bucket, upload_path, path_end))
 
     def have_upload_changes(self, s3_id: str, bucket: str, upload_name: str) -> bool:
         """ Returns True if there are changes in the database for the upload
@@ -876,16 +989,12 @@ class SPDSQLite:
         if self._conn is None:
             raise RuntimeError('Attempting to check for images edits before connecting')
 
-        # Get the edits
-        cursor = self._conn.cursor()
-        cursor.execute('SELECT count(1) FROM image_edits WHERE ' \
-                                    's3_id=? AND bucket=? AND s3_file_path like ? ',
-                            (s3_id, bucket, '%'+upload_name+'%'))
-
-        res = cursor.fetchone()
-        cursor.close()
+        # Stop looking at the first edit found
+        res = self._conn.execute('SELECT EXISTS(SELECT 1 FROM image_edits WHERE ' \
+                                    's3_id=? AND bucket=? AND s3_file_path like ?)',
+                            (s3_id, bucket, '%'+upload_name+'%')).fetchone()
 
-        return res is not None and len(res) > 0 and int(res[0]) > 0
+        return res is not None and bool(res[0])
 
 
     def get_admin_edit_users(self, s3_id: str) -> tuple:
@@ -906,7 +1015,7 @@ class SPDSQLite:
                                                         'ORDER BY name ASC', (s3_id, ))
 
         res = cursor.fetchall()
-        if not res or len(res) < 1:
+        if not res:
             cursor.close()
             return []
 
@@ -931,13 +1040,10 @@ class SPDSQLite:
             params = (new_email, old_name, s3_id)
         else:
             query = 'UPDATE users SET email=?, administrator=? WHERE name=? AND s3_id=?'
-            params = (new_email, isinstance(admin, bool) and admin is True, old_name, s3_id)
+            params = (new_email, 1 if admin else 0, old_name, s3_id)
 
         with self.transaction():
-            cursor = self._conn.cursor()
-            cursor.execute(query, params)
-
-            cursor.close()
+            self._conn.execute(query, params)
 
     def update_species(self, s3_id: str, username: str, old_scientific: str, new_scientific: str, \
                                         new_name: str, new_keybind: str, new_icon_url: str) -> bool:
@@ -958,26 +1064,17 @@ class SPDSQLite:
             raise RuntimeError('Attempting to add a species update into the database before ' \
                                                                                     'connecting')
 
-        updated = False
+        # Nothing is added when the user isn't found
         with self.transaction():
-            cursor = self._conn.cursor()
-            cursor.execute('SELECT id FROM users WHERE name=? AND s3_id=?', (username, s3_id))
-
-            res = cursor.fetchall()
-
-            if res and len(res) >= 1:
-                user_id = res[0][0]
+            cursor = self._conn.execute('INSERT INTO admin_species_edits(s3_id, user_id, ' \
+                            'timestamp, old_scientific_name, new_scientific_name, name, keybind, ' \
+                            'iconURL) ' \
+                        'SELECT ?,id,strftime("%s", "now"),?,?,?,?,? FROM users ' \
+                            'WHERE name=? AND s3_id=? LIMIT 1',
+                                    (s3_id, old_scientific, new_scientific, new_name, \
+                                            new_keybind, new_icon_url, username, s3_id))
 
-                cursor.execute('INSERT INTO admin_species_edits(s3_id, user_id, timestamp, ' \
-                            'old_scientific_name, new_scientific_name, name, keybind, iconURL) ' \
-                            'VALUES(?,?,strftime("%s", "now"),?,?,?,?,?)',
-                                    (s3_id, user_id, old_scientific, new_scientific, new_name, \
-                                            new_keybind, new_icon_url))
-                updated = True
-
-            cursor.close()
-
-        return updated
+        return cursor.rowcount > 0
 
     def update_location(self, s3_id: str, username: str, loc_name: str, loc_id: str, \
                         loc_active: bool, loc_ele: float, loc_old_lat: float, loc_old_lng: float, \
@@ -1004,28 +1101,19 @@ class SPDSQLite:
             raise RuntimeError('Attempting to add a location update into the database before ' \
                                                                                     'connecting')
 
-        updated = False
+        # Nothing is added when the user isn't found
         with self.transaction():
-            cursor = self._conn.cursor()
-            cursor.execute('SELECT id FROM users WHERE name=? AND s3_id=?', (username, s3_id))
-
-            res = cursor.fetchall()
-
-            if res and len(res) >= 1:
-                user_id = res[0][0]
-
-                cursor.execute('INSERT INTO admin_location_edits(s3_id, user_id, timestamp, ' \
-                                        'loc_name, loc_id, loc_active, loc_ele, loc_old_lat, ' \
-                                        'loc_old_lng, loc_new_lat, loc_new_lng, loc_description) ' \
-                            'VALUES(?,?,strftime("%s", "now"),?,?,?,?,?,?,?,?,?)',
-                                    (s3_id, user_id, loc_name, loc_id, loc_active, loc_ele, \
+            cursor = self._conn.execute('INSERT INTO admin_location_edits(s3_id, user_id, ' \
+                                        'timestamp, loc_name, loc_id, loc_active, loc_ele, ' \
+                                        'loc_old_lat, loc_old_lng, loc_new_lat, loc_new_lng, ' \
+                                        'loc_description) ' \
+                        'SELECT ?,id,strftime("%s", "now"),?,?,?,?,?,?,?,?,? FROM users ' \
+                            'WHERE name=? AND s3_id=? LIMIT 1',
+                                    (s3_id, loc_name, loc_id, loc_active, loc_ele, \
                                             loc_old_lat, loc_old_lng, loc_new_lat,loc_new_lng,
-                                            description))
-                updated = True
+                                            description, username, s3_id))
 
-            cursor.close()
-
-        return updated
+        return cursor.rowcount > 0
 
     def get_admin_locations(self, s3_id: str, username: str) -> dict:
         """ Returns any saved administrative location changes
@@ -1039,18 +1127,12 @@ class SPDSQLite:
             raise RuntimeError('Attempting to get administrative locations from the database '\
                                                                                 'before connecting')
 
-        cursor = self._conn.cursor()
-
-        cursor.execute('WITH u AS (SELECT id FROM users WHERE name=? AND s3_id=?) ' \
-                        'SELECT loc_name, loc_id, loc_active, loc_ele, loc_old_lat, loc_old_lng, ' \
-                            'loc_new_lat, loc_new_lng, loc_description ' \
-                        'FROM admin_location_edits ale, u '\
-                        'WHERE ale.s3_id=? AND ale.user_id = u.id AND ale.location_updated = 0 ' \
-                        'ORDER BY timestamp ASC', (username, s3_id, s3_id))
-        res = cursor.fetchall()
-        cursor.close()
-
-        return res
+        return self._conn.execute('SELECT loc_name, loc_id, loc_active, loc_ele, loc_old_lat, ' \
+                            'loc_old_lng, loc_new_lat, loc_new_lng, loc_description ' \
+                        'FROM admin_location_edits ale JOIN users u ON u.id = ale.user_id ' \
+                        'WHERE u.name=? AND u.s3_id=? AND ale.s3_id=? ' \
+                            'AND ale.location_updated = 0 ' \
+                        'ORDER BY ale.timestamp ASC', (username, s3_id, s3_id)).fetchall()
 
     def get_admin_species(self, s3_id: str, username: str) -> dict:
         """ Returns any saved administrative species changes
@@ -1064,61 +1146,32 @@ class SPDSQLite:
             raise RuntimeError('Attempting to get administrative species from the database before '\
                                                                                     'connecting')
 
-        cursor = self._conn.cursor()
+        return self._conn.execute('SELECT ase.old_scientific_name, ase.new_scientific_name, ' \
+                            'ase.name, ase.keybind, ase.iconURL ' \
+                        'FROM admin_species_edits ase JOIN users u ON u.id = ase.user_id ' \
+                        'WHERE u.name=? AND u.s3_id=? AND ase.s3_id=? AND ase.s3_updated = 0 ' \
+                        'ORDER BY ase.timestamp ASC', (username, s3_id, s3_id)).fetchall()
 
-        cursor.execute('WITH u AS (SELECT id FROM users WHERE name=? AND s3_id=?) ' \
-                        'SELECT old_scientific_name, new_scientific_name, name, keybind, iconURL '\
-                        'FROM admin_species_edits ase, u ' \
-                        'WHERE ase.s3_id=? AND ase.user_id = u.id AND ase.s3_updated = 0 ' \
-                        'ORDER BY timestamp ASC', (username, s3_id, s3_id))
-        res = cursor.fetchall()
-        cursor.close()
-
-        return res
-
-    def admin_location_counts(self, s3_id: str, username: str) -> dict:
-        """ Returns any saved administrative location changes
+    def admin_counts(self, s3_id: str, username: str) -> tuple:
+        """ Returns the counts of saved administrative location and species changes
         Arguments:
             s3_id: the ID to the S3 instance
             username: the name of the user to fetch for
         Return:
-            Returns a result tuple containing the count
+            Returns a result tuple containing the location count and the species count
         """
         if self._conn is None:
-            raise RuntimeError('Attempting to get administrative location change counts from the ' \
+            raise RuntimeError('Attempting to get administrative change counts from the ' \
                                                                     'database before connecting')
 
-        cursor = self._conn.cursor()
-        cursor.execute('WITH u AS (SELECT id FROM users WHERE name=? AND s3_id=?) ' \
-                        'SELECT count(1) FROM admin_location_edits ale, u ' \
-                        'WHERE ale.s3_id=? AND ale.user_id = u.id AND ale.location_updated = 0',
-                                                                        (username, s3_id, s3_id))
-        res = cursor.fetchone()
-        cursor.close()
-
-        return res
-
-
-    def admin_species_counts(self, s3_id: str, username: str) -> dict:
-        """ Returns any saved administrative species changes
-        Arguments:
-            s3_id: the ID to the S3 instance
-            username: the name of the user to fetch for
-        Return:
-            Returns a result tuple containing the count
-        """
-        if self._conn is None:
-            raise RuntimeError('Attempting to get administrative species change counts from the '\
-                                                                    'database before connecting')
-        cursor = self._conn.cursor()
-        cursor.execute('WITH u AS (SELECT id FROM users WHERE name=? AND s3_id=?) ' \
-                        'SELECT count(1) FROM admin_species_edits ase, u ' \
-                        'WHERE ase.s3_id=? AND ase.user_id = u.id AND ase.s3_updated = 0',
-                                                                        (username, s3_id, s3_id))
-        res = cursor.fetchone()
-        cursor.close()
-
-        return res
+        return self._conn.execute('SELECT (SELECT count(1) FROM admin_location_edits ale ' \
+                            'JOIN users u ON u.id = ale.user_id ' \
+                        'WHERE u.name=? AND u.s3_id=? AND ale.s3_id=? ' \
+                            'AND ale.location_updated = 0), ' \
+                    '(SELECT count(1) FROM admin_species_edits ase ' \
+                            'JOIN users u ON u.id = ase.user_id ' \
+                        'WHERE u.name=? AND u.s3_id=? AND ase.s3_id=? AND ase.s3_updated = 0)',
+                                (username, s3_id, s3_id, username, s3_id, s3_id)).fetchone()
 
     def clear_admin_location_changes(self, s3_id: str, username: str) -> None:
         """ Cleans up the administration location changes for this use
@@ -1131,12 +1184,10 @@ class SPDSQLite:
                                                                                 'before connecting')
 
         with self.transaction():
-            cursor = self._conn.cursor()
             query = 'UPDATE admin_location_edits SET location_updated = 1 WHERE s3_id=? ' \
-                        'AND user_id IN (SELECT id FROM users WHERE name=? AND s3_id=?)'
-            cursor.execute(query, (s3_id, username, s3_id))
-
-            cursor.close()
+                        'AND user_id IN (SELECT id FROM users WHERE name=? AND s3_id=?) ' \
+                        'AND location_updated = 0'
+            self._conn.execute(query, (s3_id, username, s3_id))
 
     def clear_admin_species_changes(self, s3_id: str, username: str) -> None:
         """ Cleans up the administration species changes for this use
@@ -1149,12 +1200,9 @@ class SPDSQLite:
                                                                                 'before connecting')
 
         with self.transaction():
-            cursor = self._conn.cursor()
             query = 'UPDATE admin_species_edits SET s3_updated = 1 WHERE s3_id=? AND user_id in ' \
-                        '(SELECT id FROM users where name=? AND s3_id=?)'
-            cursor.execute(query, (s3_id, username, s3_id))
-
-            cursor.close()
+                        '(SELECT id FROM users where name=? AND s3_id=?) AND s3_updated = 0'
+            self._conn.execute(query, (s3_id, username, s3_id))
 
     def remove_edit_locations(self, s3_id: str, location_id: str) -> None:
         """ Removes location edits that reference this location
@@ -1167,12 +1215,9 @@ class SPDSQLite:
                                                                     'database before connecting')
 
         with self.transaction():
-            cursor = self._conn.cursor()
-            cursor.execute('DELETE FROM admin_location_edits WHERE s3_id=? AND loc_id=?',
+            self._conn.execute('DELETE FROM admin_location_edits WHERE s3_id=? AND loc_id=?',
                                                                             (s3_id, location_id))
 
-            cursor.close()
-
     def get_next_upload_location(self, s3_id: str, username: str) -> Optional[dict]:
         """ Returns the next edit location for this user at the specified endpoint
         Arguments:
@@ -1181,20 +1226,20 @@ class SPDSQLite:
         Return:
             Returns a tuple with the bucket, S3 upload path, location ID, location name,
             and location elevation
+        Notes:
+            The returned edit is claimed by marking it as updated in the same statement, so
+            concurrent callers never get the same edit
         """
         if self._conn is None:
             raise RuntimeError('Attempting to get location edits from the database '\
                                                                                 'before connecting')
 
-        cursor = self._conn.cursor()
-        cursor.execute('SELECT bucket, s3_base_path, loc_id, loc_name, loc_ele FROM ' \
-                            'collection_edits WHERE s3_id=? AND username=? AND updated=0 LIMIT 1',
-                        (s3_id, username))
-
-        res = cursor.fetchone()
-        cursor.close()
-
-        return res
+        with self.transaction():
+            return self._conn.execute('UPDATE collection_edits SET updated=1, edit_timestamp=? ' \
+                            'WHERE id=(SELECT id FROM collection_edits ' \
+                                'WHERE s3_id=? AND username=? AND updated=0 LIMIT 1) ' \
+                            'RETURNING bucket, s3_base_path, loc_id, loc_name, loc_ele',
+                                  (int(time()), s3_id, username)).fetchone()
 
     def complete_upload_location(self, s3_id: str, username: str, bucket: str, \
                                                                             base_path: str) -> None:
@@ -1204,23 +1249,23 @@ class SPDSQLite:
             username: the name of the user to check for
             bucket: the bucket associated with the location change
             base_path: the upload path where the location was change
+        Notes:
+            Edits returned by get_next_upload_location() are already marked as updated. This
+            marks any other edits for the same upload
         """
         if self._conn is None:
             raise RuntimeError('Attempting to get location edits from the database '\
                                                                                 'before connecting')
 
+        # The timestamp is bound once instead of having SQLite determine it for each row
         with self.transaction():
-            cursor = self._conn.cursor()
-            cursor.execute('UPDATE collection_edits SET updated=1, ' \
-                                                            'edit_timestamp=strftime("%s", "now") '\
+            self._conn.execute('UPDATE collection_edits SET updated=1, edit_timestamp=? ' \
                                 'WHERE s3_id=? AND username=? AND bucket=? AND s3_base_path=?',
-                            (s3_id, username, bucket, base_path))
-
-            cursor.close()
+                            (int(time()), s3_id, username, bucket, base_path))
 
     def get_next_files_info(self, s3_id: str, username: str, updated_value: int, s3_path:str=None,\
                                             upload_id: str=None, \
-                                            check_smaller_values: bool=False) -> Optional[tuple]:
+                                            check_smaller_values: bool=False) -> Iterator[tuple]:
         """ Returns the file editing information for a user, possibly for only one location
         Arguments:
             s3_id: the ID to the S3 instance
@@ -1231,10 +1276,12 @@ class SPDSQLite:
             check_smaller_values: When set to True, the updated value parameter is considered an
                                 upper bound - any entries with a smaller or equal value is returned
         Return:
-            Returns a tuple of row tuples containing the bucket, S3 file path, observation common
-            name, observation scientific name, observation count, and associated request ID
+            Returns an iterator over the row tuples containing the bucket, S3 file path, observation
+            common name, observation scientific name, observation count, and associated request ID
         Notes:
             It's recommended that only one of the S3 path, or the upload ID, is specified, not both.
+            The rows are fetched as they're iterated over, so they need to be consumed before
+            the connection is closed.
             See also add_image_species_edit().
         """
         # pylint: disable=too-many-arguments,too-many-positional-arguments
@@ -1242,27 +1289,15 @@ class SPDSQLite:
             raise RuntimeError('Attempting to get common file edits fron the database '\
                                                                                 'before connecting')
 
-        updated_query_fragment = 'AND updated <= ?' if check_smaller_values is True else \
-                                                                                    'AND updated=? '
-
-        cursor = self._conn.cursor()
-        query = 'SELECT bucket, s3_file_path, obs_common, obs_scientific, obs_count, request_id ' +\
-                                    'FROM image_edits WHERE s3_id=? AND username=? ' + \
-                                    updated_query_fragment + \
-                                    ('AND s3_file_path=? ' if s3_path is not None else '') + \
-                                    ('AND s3_file_path LIKE ? ' if upload_id is not None else '') +\
-                                    'ORDER BY obs_scientific ASC, edit_timestamp ASC'
         if upload_id is not None:
             upload_id = '%' + upload_id + '%'
         query_data = tuple(val for val in [s3_id, username, updated_value, s3_path, upload_id] \
                                                                                 if val is not None)
 
-        cursor.execute(query, query_data)
-
-        res = cursor.fetchall()
-        cursor.close()
-
-        return res
+        return self._conn.execute(NEXT_FILES_SQL[(check_smaller_values is True,
+                                                  s3_path is not None,
+                                                  upload_id is not None)],
+                                  query_data)
 
     def complete_collection_edits(self, username: str, collection_info: dict) -> None:
         """ Marks the collection edit as completed
@@ -1276,14 +1311,11 @@ class SPDSQLite:
                                                                                 'before connecting')
 
         with self.transaction():
-            cursor = self._conn.cursor()
-            cursor.execute('UPDATE collection_edits SET updated=1 ' \
+            self._conn.execute('UPDATE collection_edits SET updated=1 ' \
                                     'WHERE s3_id=? AND username=? AND bucket=? AND s3_base_path=?',
                         (collection_info['s3_url'], username, collection_info['bucket'], \
                                                                     collection_info['base_path']))
 
-            cursor.close()
-
     def complete_image_edits(self, username: str, files: tuple, old_updated: int, \
                                                                         new_updated: int) -> None:
         """ Common function to mark the files as having completed their edits
@@ -1297,33 +1329,12 @@ class SPDSQLite:
             raise RuntimeError('Attempting to mark file edits as updated in the database '\
                                                                                 'before connecting')
 
-        # Prepare to process the data in batches. We don't use a transaction with rollback for this
-        cur_idx = 0
-        count = 0
-        cursor = self._conn.cursor()
-        query = 'UPDATE image_edits SET updated=? WHERE s3_id=? AND username=? AND bucket=? AND ' \
-                's3_file_path=? AND updated=?'
-        while True:
-            cur_file = files[cur_idx]
-            cursor.execute(query, (new_updated, cur_file['s3_url'], username, cur_file['bucket'],
-                                                                cur_file['s3_path'], old_updated))
-
-            cur_idx += 1
-            count += 1
-
-            # We're done once we've gone through the files
-            if cur_idx >= len(files):
-                break
-
-            # Flush out the changes and continue processing the files
-            if count > 30:
-                self._conn.commit()
-                cursor.close()
-                cursor = self._conn.cursor()
-                count = 0
-
-        self._conn.commit()
-        cursor.close()
+        # Update all the files in one transaction
+        with self.transaction():
+            self._conn.executemany('UPDATE image_edits SET updated=? WHERE s3_id=? AND ' \
+                                        'username=? AND bucket=? AND s3_file_path=? AND updated=?',
+                                   ((new_updated, cur_file['s3_url'], username, cur_file['bucket'],
+                                     cur_file['s3_path'], old_updated) for cur_file in files))
 
     def lock_get(self, name: str, max_lock_sec: int) -> Optional[int]:
         """ Attempts to get the named lock
@@ -1340,70 +1351,28 @@ class SPDSQLite:
         # Get our lock value
         lock_value = int(datetime.datetime.now(datetime.UTC).timestamp() * 1000)
 
-        # Check for the lock existing
-        lock_exists = False
-        cursor = self._conn.cursor()
-        cursor.execute('SELECT count(1) FROM db_locks WHERE name=?', (name,))
-
-        res = cursor.fetchone()
-        if res and len(res) > 0 and int(res[0]) > 0:
-            lock_exists = True
-
-        cursor.close()
-
-        # Attempt to update or insert the lock information
-        # We loop here for a more robust handling than the connection's loop timeout feature
-        cursor = self._conn.cursor()
-        tries = 0
-        while True:
-            try:
-                if lock_exists:
-                    cursor.execute('UPDATE db_locks SET value=?, timestamp=strftime("%s", "now") ' \
-                                        'WHERE name=? AND ' \
-                                            '(value IS NULL OR strftime("%s", "now")-timestamp >?)',
-                                    (lock_value, name, max_lock_sec))
-                else:
-                    cursor.execute('INSERT INTO db_locks(name, value, timestamp) ' \
-                                            'VALUES(?,?,strftime("%s", "now"))', (name, lock_value))
-                break
-            except sqlite3.OperationalError as ex:
-                tries += 1
-                if tries <= 10:
-                    sleep(1)
-                else:
-                    print(f'Error: Unable to obtain database lock {name}')
-                    print(ex)
-                    cursor.close()
-                    return None
-
-        self._conn.commit()
-
-        if cursor.rowcount > 0:
-            # Commit changes so it's seen everywhere and return the ID
-            try:
-                cursor.close()
-                cursor = self._conn.cursor()
-
-                # We fetch the value to make sure we're the one that got the lock
-                cursor.execute('SELECT value FROM db_locks WHERE name=?', (name,))
-                res = cursor.fetchone()
-
-                cursor.close()
-
-                if not res or len(res) < 1:
-                    return None
-
-                # Return the value as the lock ID if it matches what we have
-                return int(res[0]) if int(res[0]) == lock_value else None
+        # Add the lock, or take it over if it's free or abandoned, in one statement. A row is
+        # only returned when we got the lock. Lock contention with other connections is waited
+        # out by the connection's busy timeout
+        try:
+            with self.transaction():
+                res = self._conn.execute('INSERT INTO db_locks(name, value, timestamp) ' \
+                                            'VALUES(?,?,strftime("%s", "now")) ' \
+                                        'ON CONFLICT(name) DO UPDATE SET value=excluded.value, ' \
+                                            'timestamp=excluded.timestamp ' \
+                                        'WHERE db_locks.value IS NULL OR ' \
+                                            'strftime("%s", "now")-db_locks.timestamp > ? ' \
+                                        'RETURNING value',
+                                    (name, lock_value, max_lock_sec)).fetchone()
+        except sqlite3.Error as ex:
+            self._logger.error('Unable to obtain database lock %s: %s', name, ex)
+            return None
 
-            except sqlite3.Error as ex:
-                print('Error: named lock error caught', flush=True)
-                print(ex, flush=True)
-                cursor.close()
-                return None
+        if not res:
+            return None
 
-        cursor.close()
-        return None
+        # Return the value as the lock ID if it matches what we have
+        return int(res[0]) if int(res[0]) == lock_value else None
 
     def lock_release(self, name: str, value: int) -> None:
         """ Releases a named lock
@@ -1418,11 +1387,8 @@ class SPDSQLite:
                                                                                     'connecting')
 
         with self.transaction():
-            cursor = self._conn.cursor()
-            cursor.execute('UPDATE db_locks SET value=NULL,timestamp=NULL WHERE name=? AND value=?',
-                                                                                    (name, value))
-
-            cursor.close()
+            self._conn.execute('UPDATE db_locks SET value=NULL,timestamp=NULL WHERE name=? AND ' \
+                                                                    'value=?', (name, value))
 
     def count_admin(self, s3_id: str) -> int:
         """ Counts the number of administrators found in the database for the S3 endpoint
@@ -1444,7 +1410,7 @@ class SPDSQLite:
         res = cursor.fetchone()
         cursor.close()
 
-        if not res or len(res) < 1:
+        if not res:
             return 0
 
         return int(res[0])
@@ -1469,7 +1435,7 @@ class SPDSQLite:
         cursor.close()
 
         # Check for a problem
-        if not res or len(res) < 1:
+        if not res:
             return False
 
         # Check that there are any other users
@@ -1483,7 +1449,7 @@ class SPDSQLite:
         res = cursor.fetchone()
 
         # Check for a problem
-        if not res or len(res) < 1:
+        if not res:
             return False
 
         return int(res[0]) == 1
@@ -1502,7 +1468,7 @@ class SPDSQLite:
         res = cursor.fetchall()
 
         # Check for a problem
-        if not res or len(res) < 1:
+        if not res:
             return None
 
         return res
@@ -1521,12 +1487,9 @@ class SPDSQLite:
             raise RuntimeError('Attempting to add a message to the database before ' \
                                                                                     'connecting')
         with self.transaction():
-            cursor = self._conn.cursor()
             query = 'INSERT INTO messages(s3_id, sender, receiver, subject, message, priority, ' \
                     'timestamp) VALUES(?,?,?,?,?,?,strftime("%s", "now"))'
-            cursor.execute(query, (s3_id, sender, receiver, subject, message, priority))
-
-            cursor.close()
+            self._conn.execute(query, (s3_id, sender, receiver, subject, message, priority))
 
     def messages_get(self, s3_id: str, username: str, admin: bool=False) -> tuple:
         """ Adds a message to the database
@@ -1552,14 +1515,15 @@ class SPDSQLite:
                     'read_sec':     7,
                     }
 
+        # The current time is bound once instead of having SQLite determine it for each row
         cursor = self._conn.cursor()
         query = 'SELECT id, receiver, sender, subject, message, priority, ' \
-                        '(strftime("%s", "now")-timestamp) as elapsed_sec,' \
-                        '(strftime("%s", "now")-read_timestamp) as read_sec ' \
+                        '(?1-timestamp) as elapsed_sec,' \
+                        '(?1-read_timestamp) as read_sec ' \
                     'FROM messages ' \
-                    'WHERE s3_id=? AND deleted=0 AND '
-        query += '(receiver=? OR receiver="admin")' if admin is True else 'receiver=?'
-        cursor.execute(query, (s3_id, username))
+                    'WHERE s3_id=?2 AND deleted=0 AND '
+        query += '(receiver=?3 OR receiver="admin")' if admin is True else 'receiver=?3'
+        cursor.execute(query, (int(time()), s3_id, username))
 
         res = cursor.fetchall()
         cursor.close()
@@ -1577,17 +1541,15 @@ class SPDSQLite:
             raise RuntimeError('Attempting to mark messages as read in the database before ' \
                                                                                     'connecting')
         # Check if there's nothing to do
-        if ids is None or len(ids) <= 0:
+        if not ids:
             return
 
+        # The timestamp is bound once instead of having SQLite determine it for each message
         with self.transaction():
-            cursor = self._conn.cursor()
-            id_params = ','.join('?' * len(ids))
-            query = 'UPDATE messages SET read_timestamp=strftime("%s", "now") WHERE s3_id=? AND ' \
+            id_params = _sql_params(len(ids))
+            query = 'UPDATE messages SET read_timestamp=? WHERE s3_id=? AND ' \
                                                         'receiver=? AND id IN (' + id_params + ')'
-            cursor.execute(query, (s3_id, username) + tuple(ids))
-
-            cursor.close()
+            self._conn.execute(query, (int(time()), s3_id, username) + tuple(ids))
 
     def messages_are_deleted(self, s3_id: str, username: str, ids: tuple) -> None:
         """ Marks messages as deleted
@@ -1600,17 +1562,14 @@ class SPDSQLite:
             raise RuntimeError('Attempting to mark messages as deleted the database before ' \
                                                                                     'connecting')
         # Check if there's nothing to do
-        if ids is None or len(ids) <= 0:
+        if not ids:
             return
 
         with self.transaction():
-            cursor = self._conn.cursor()
-            id_params = ','.join('?' * len(ids))
+            id_params = _sql_params(len(ids))
             query = 'UPDATE messages SET deleted=1 WHERE s3_id=? AND receiver=? AND ' \
                                                                         'id IN (' + id_params + ')'
-            cursor.execute(query, (s3_id, username) + tuple(ids))
-
-            cursor.close()
+            self._conn.execute(query, (s3_id, username) + tuple(ids))
 
     def message_count(self, s3_id: str, username: str) -> Optional[int]:
         """ Returns the number of messages for a recipient
@@ -1632,7 +1591,7 @@ class SPDSQLite:
         cursor.close()
 
         # Make sure we have something
-        if not res or len(res) <= 0:
+        if not res:
             return None
 
         # Return the best integer answer
@@ -0,0 +1,237 @@
+"""This script contains the SQLite connection handling shared by the SPARCd Web app databases
+"""
+
+from contextlib import contextmanager
+import logging
+import queue
+import sqlite3
+import threading
+from typing import Generator
+
+# Oldest SQLite library supported, RETURNING clauses need at least this version
+MIN_SQLITE_VERSION = (3, 35, 0)
+if sqlite3.sqlite_version_info < MIN_SQLITE_VERSION:
+    raise RuntimeError(f'SQLite {sqlite3.sqlite_version} is too old, at least version ' \
+                                    f'{".".join(map(str, MIN_SQLITE_VERSION))} is required')
+
+# Maximum number of idle connections kept open for each database file
+MAX_POOLED_CONNECTIONS = 8
+
+# Number of prepared statements each connection keeps around for reuse
+SQLITE_CACHED_STATEMENTS = 256
+
+# Number of bytes of the database file to memory map
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+# Size of the page cache of each connection in KiB
+SQLITE_CACHE_SIZE_KB = 64 * 1024
+# Number of WAL pages written before the WAL is checkpointed into the database
+SQLITE_WAL_AUTOCHECKPOINT = 1000
+# Number of milliseconds a connection waits on another connection's lock before giving up
+SQLITE_BUSY_TIMEOUT_MS = 10000
+
+# Settings applied to each new connection
+SQLITE_PRAGMAS = {
+    'synchronous': 'NORMAL',
+    'temp_store': 'MEMORY',
+    'mmap_size': SQLITE_MMAP_SIZE,
+    'cache_size': -SQLITE_CACHE_SIZE_KB,
+    'wal_autocheckpoint': SQLITE_WAL_AUTOCHECKPOINT,
+    'busy_timeout': SQLITE_BUSY_TIMEOUT_MS,
+}
+
+# Information on the database returned by database_info()
+DATABASE_INFO = (
+     'SQLite database',
+     f'Version: {sqlite3.sqlite_version}',
+     f'thread safety: {sqlite3.threadsafety}',
+     f'api level: {sqlite3.apilevel}',
+    )
+
+# Idle connections keyed by database path
+_POOL = {}
+_POOL_LOCK = threading.Lock()
+# Paths of the databases that have been checked for indexes and triggers
+_INDEXED_PATHS = set()
+# Held while a database is being checked for indexes and triggers
+_SCHEMA_LOCK = threading.Lock()
+
+
+def _get_pool(database_path: str) -> queue.LifoQueue:
+    """ Returns the pool of idle connections for a database
+    Arguments:
+        database_path: the path to the database file
+    Return:
+        The stack of idle connections to the database. The most recently used connection is
+        handed out first
+    """
+    with _POOL_LOCK:
+        if database_path not in _POOL:
+            _POOL[database_path] = queue.LifoQueue(maxsize=MAX_POOLED_CONNECTIONS)
+        return _POOL[database_path]
+
+
+class SPDSQLiteBase:
+    """Class handling the pooled connection to a database
+    """
+
+    # Statements run the first time a database is connected to, creating any missing indexes
+    # and triggers
+    SCHEMA_STATEMENTS = ()
+
+    def __init__(self, db_path: str, logger: logging.Logger=None, verbose: bool=False):
+        """Initialize an instance
+        Arguments:
+            db_path: the path to the database file
+            logger: a logging instance
+            verbose: set to True to have more verbose logging
+        Notes:
+            Idle connections are shared by all instances using the same database
+        """
+        self._conn = None
+        self._conn_path = None
+        self._path = db_path
+        self._verbose = verbose
+        self._logger = logger if logger is not None else logging.getLogger(type(self).__module__)
+        self._savepoint_counter = 0
+
+    def __enter__(self) -> 'SPDSQLiteBase':
+        """Connects to the database when entering a with block
+        """
+        self.reconnect()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback) -> None:
+        """Releases the connection when leaving a with block
+        """
+        self.close()
+
+    @contextmanager
+    def transaction(self) -> Generator:
+        """Context manager for atomic database transactions
+        Yields:
+            The active database connection
+        Raises:
+            RuntimeError: If called before connecting to the database
+        Usage:
+            with self.transaction():
+                cursor.execute(...)
+                cursor.execute(...)
+        """
+        if self._conn is None:
+            raise RuntimeError('Attempting to start a transaction before connecting')
+
+        # Use a savepoint if a transaction is already active
+        in_transaction = self._conn.in_transaction
+        savepoint = None
+
+        try:
+            if in_transaction:
+                self._savepoint_counter += 1
+                savepoint = f'sp_{self._savepoint_counter}'
+                self._conn.execute(f'SAVEPOINT {savepoint}')
+            else:
+                # Take the write lock up front so that a read followed by a write can't fail
+                # part way through when another connection is writing
+                self._conn.execute('BEGIN IMMEDIATE')
+            yield self._conn
+            if in_transaction:
+                self._conn.execute(f'RELEASE SAVEPOINT {savepoint}')
+            else:
+                self._conn.commit()
+        except Exception:  # pylint: disable=broad-exception-caught
+            if in_transaction:
+                self._conn.execute(f'ROLLBACK TO SAVEPOINT {savepoint}')
+                self._conn.execute(f'RELEASE SAVEPOINT {savepoint}')
+            else:
+                self._conn.rollback()
+            raise
+
+    def database_info(self) -> tuple:
+        """ Returns information on the database as a tuple of strings
+        """
+        return DATABASE_INFO
+
+    def connect(self, database_path: str = None) -> None:
+        """Performs the actual connection to the database
+        Arguments:
+            database: the database to connect to
+        """
+        database_path = database_path if database_path is not None else self._path
+        if self._conn is None:
+            if self._verbose:
+                self._logger.info('Connecting to the database database=%s', database_path)
+            # Reuse an idle connection before opening a new one
+            try:
+                self._conn = _get_pool(database_path).get_nowait()
+            except queue.Empty:
+                # We disable thread checking since we're using thread-safe Sqlite
+                self._conn = sqlite3.connect(database_path, check_same_thread=False,
+                                             cached_statements=SQLITE_CACHED_STATEMENTS)
+                # In-memory databases can't use a write-ahead log
+                if database_path != ':memory:':
+                    self._conn.execute('PRAGMA journal_mode=WAL')
+                for name, value in SQLITE_PRAGMAS.items():
+                    self._conn.execute(f'PRAGMA {name}={value}')
+            self._conn_path = database_path
+            if database_path not in _INDEXED_PATHS:
+                try:
+                    self.__ensure_schema(database_path)
+                except sqlite3.Error:
+                    self.close()
+                    raise
+
+    def __ensure_schema(self, database_path: str) -> None:
+        """ Runs the SCHEMA_STATEMENTS the first time a database is connected to
+        Arguments:
+            database_path: the path of the connected database
+        Raises:
+            sqlite3.Error: if the indexes and triggers can't be created. Queries such as the
+                upserts rely on the unique indexes so the database isn't usable without them
+        """
+        # Other connections wait here until the first one is done. The path is only recorded
+        # once the changes are committed
+        with _SCHEMA_LOCK:
+            if database_path in _INDEXED_PATHS:
+                return
+
+            try:
+                with self.transaction():
+                    for one_stmt in self.SCHEMA_STATEMENTS:
+                        self._conn.execute(one_stmt)
+            except sqlite3.Error as ex:
+                self._logger.error('Unable to create indexes and triggers for database %s: %s',
+                                                                            database_path, ex)
+                raise
+
+            _INDEXED_PATHS.add(database_path)
+
+    def optimize(self) -> None:
+        """ Lets SQLite refresh its query planner statistics and checkpoints the WAL without
+            waiting on readers or writers
+        """
+        if self._conn is None:
+            raise RuntimeError('Attempting to optimize the database before connecting')
+
+        self._conn.execute('PRAGMA optimize')
+        self._conn.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchall()
+
+    def reconnect(self) -> None:
+        """Attempts a reconnection if we're not connected
+        """
+        if self._conn is None:
+            self.connect()
+
+    def close(self) -> None:
+        """ Releases the connection to the database. The connection is kept open for reuse
+            unless there are already enough idle connections
+        """
+        if self._conn:
+            conn = self._conn
+            self._conn = None
+            # Anything not committed is discarded, the same as closing the connection would
+            if conn.in_transaction:
+                conn.rollback()
+            try:
+                _get_pool(self._conn_path).put_nowait(conn)
+            except queue.Full:
+                conn.close()
@@ -1,72 +1,57 @@
 """This script contains the SQLite database interface for the SPARCd Web app sandbox tabled
 """
 
-from contextlib import contextmanager
 import datetime
+import functools
 import hashlib
-import logging
 import sqlite3
-from typing import Generator, Optional
+from time import time
+from typing import Iterator, Optional
 import uuid
 
-class SPDSQLiteSandbox:
+from spd_database.spdsqlite_base import SPDSQLiteBase
+
+# Maximum number of sandbox files added by a single INSERT statement. Each file uses one
+# parameter, plus the shared sandbox ID and timestamp, which keeps us well under the SQLite
+# default limit of 999 bound parameters
+MAX_FILES_PER_INSERT = 300
+# Maximum number of multi-row INSERT statements to keep around
+MAX_INSERT_SQL_CACHE = 32
+
+# Indexes for the lookups made while uploads are in progress
+SANDBOX_INDEXES = (
+    'CREATE INDEX IF NOT EXISTS idx_sandbox_name_upload ON sandbox(name, upload_id)',
+    'CREATE INDEX IF NOT EXISTS idx_sandbox_s3_name ON sandbox(s3_id, name)',
+    'CREATE INDEX IF NOT EXISTS idx_sandbox_files_sid_status ON ' \
+                                                    'sandbox_files(sandbox_id, completion_status)',
+    'CREATE INDEX IF NOT EXISTS idx_sandbox_species_file ON sandbox_species(sandbox_file_id)',
+    # Each uploaded or renamed file is found by name within its upload
+    'CREATE INDEX IF NOT EXISTS idx_sandbox_files_sid_filename ON ' \
+                                                    'sandbox_files(sandbox_id, filename)',
+)
+
+
+@functools.lru_cache(maxsize=MAX_INSERT_SQL_CACHE)
+def _insert_files_sql(count: int) -> str:
+    """ Returns the statement for adding files to a sandbox
+    Arguments:
+        count: the number of files added by the statement
+    Return:
+        The multi-row INSERT statement. The first parameter is the sandbox ID, the second is
+        the timestamp, and the rest are the files
+    Notes:
+        Each file is both the filename and source path so its parameter is used twice
+    """
+    return 'INSERT INTO sandbox_files(sandbox_id, filename, source_path, timestamp) VALUES ' + \
+                    ','.join(f'(?1,?{idx},?{idx},?2)' for idx in range(3, count + 3))
+
+
+class SPDSQLiteSandbox(SPDSQLiteBase):
     """Class handling access connections to the database for sandbox tables
     """
 
-    def __init__(self, db_path: str, logger: logging.Logger=None, verbose: bool=False):
-        """Initialize an instance
-        Arguments:
-            db_path: the path to the database file
-            logger: a logging instance
-            verbose: set to True to have more verbose logging
-        """
-        self._conn = None
-        self._path = db_path
-        self._verbose = verbose
-        self._logger = logger
-        self._savepoint_counter = 0
-
-    def __del__(self):
-        """Handles closing the connection and other cleanup
-        """
-        self.close()
-
-    @contextmanager
-    def transaction(self) -> Generator:
-        """Context manager for atomic database transactions
-        Yields:
-            The active database connection
-        Raises:
-            RuntimeError: If called before connecting to the database
-        Usage:
-            with self.transaction():
-                cursor.execute(...)
-                cursor.execute(...)
-        """
-        if self._conn is None:
-            raise RuntimeError('Attempting to start a transaction before connecting')
-
-        # Use a savepoint if a transaction is already active
-        in_transaction = self._conn.in_transaction
-        savepoint = None
-
-        try:
-            if in_transaction:
-                self._savepoint_counter += 1
-                savepoint = f'sp_{self._savepoint_counter}'
-                self._conn.execute(f'SAVEPOINT {savepoint}')
-            yield self._conn
-            if in_transaction:
-                self._conn.execute(f'RELEASE SAVEPOINT {savepoint}')
-            else:
-                self._conn.commit()
-        except Exception:  # pylint: disable=broad-exception-caught
-            if in_transaction:
-                self._conn.execute(f'ROLLBACK TO SAVEPOINT {savepoint}')
-                self._conn.execute(f'RELEASE SAVEPOINT {savepoint}')
-            else:
-                self._conn.rollback()
-            raise
+    # Creates the indexes
+    SCHEMA_STATEMENTS = SANDBOX_INDEXES
 
     def hash2str(self, text: str) -> str:
         """ Returns the hash of the passed in string
@@ -77,48 +62,6 @@ class SPDSQLiteSandbox:
         """
         return hashlib.md5(text.encode('utf-8')).hexdigest()
 
-    def database_info(self) -> tuple:
-        """ Returns information on the database as a tuple of strings
-        """
-        return (
-             'SQLite database',
-             f'Version: {sqlite3.sqlite_version}',
-             f'thread safety: {sqlite3.threadsafety}',
-             f'api level: {sqlite3.apilevel}',
-            )
-
-    def connect(self, database_path: str = None) -> None:
-        """Performs the actual connection to the database
-        Arguments:
-            database: the database to connect to
-        """
-        database_path = database_path if database_path is not None else self._path
-        if self._conn is None:
-            if self._verbose:
-                print_params = \
-                    (param for param in (
-                        f'database={database_path}' if database_path is not None else None,
-                   ) if param is not None)
-                self._logger.info(f'Connecting to the database {print_params}')
-            # We disable thread checking since we're using thread-safe Sqlite
-            self._conn = sqlite3.connect(database_path, check_same_thread=False)
-            self._conn.execute('PRAGMA journal_mode=WAL')
-            self._conn.execute('PRAGMA synchronous=NORMAL')
-            self._conn.execute('PRAGMA busy_timeout=10000')
-
-    def reconnect(self) -> None:
-        """Attempts a reconnection if we're not connected
-        """
-        if self._conn is None:
-            self.connect()
-
-    def close(self) -> None:
-        """ Closes the connection to the database
-        """
-        if self._conn:
-            self._conn.close()
-            self._conn = None
-
     def get_sandbox(self, s3_id: str) -> Optional[tuple]:
         """ Returns the sandbox items
         Arguments:
@@ -141,15 +84,9 @@ class SPDSQLiteSandbox:
                     }
 
         # Get the Sandbox information
-        cursor = self._conn.cursor()
-        cursor.execute('SELECT name, path, bucket, s3_base_path, location_id, recovered '\
-                                                                    'FROM sandbox WHERE s3_id=?',
-                        (s3_id,))
-        res = cursor.fetchall()
-
-        cursor.close()
-
-        return indexes, res
+        return indexes, self._conn.execute('SELECT name, path, bucket, s3_base_path, ' \
+                                        'location_id, recovered FROM sandbox WHERE s3_id=?',
+                                           (s3_id,)).fetchall()
 
     def sandbox_exists(self, s3_id: str, bucket: str, username: str, s3_path: str) -> bool:
         """ Checks if the sandbox entry exists
@@ -175,7 +112,7 @@ class SPDSQLiteSandbox:
         res = cursor.fetchone()
         cursor.close()
 
-        if not res or len(res) <= 0:
+        if not res:
             return False
 
         return int(res[0]) > 0
@@ -199,14 +136,11 @@ class SPDSQLiteSandbox:
 
         # Add the upload
         with self.transaction():
-            cursor = self._conn.cursor()
-            cursor.execute('INSERT INTO sandbox(s3_id, path, bucket, name, s3_base_path, ' \
+            self._conn.execute('INSERT INTO sandbox(s3_id, path, bucket, name, s3_base_path, ' \
                                     'timestamp, upload_id, recovered) ' \
                             'VALUES(?, "", ?, ?, ?, time(?), ?, 1)',
                         (s3_id, bucket, username, s3_path, timestamp.isoformat(), uuid.uuid4().hex))
 
-            cursor.close()
-
     def sandbox_set_recovered(self, s3_id: str, bucket: str, username: str, s3_path: str, \
                                                                 timestamp: datetime) -> bool:
         """ Sets a sandbox entry as recovered in the database
@@ -226,13 +160,10 @@ class SPDSQLiteSandbox:
 
         # Add the upload
         with self.transaction():
-            cursor = self._conn.cursor()
-            cursor.execute('UPDATE sandbox SET recovered=1,timestamp=?,upload_id=? WHERE ' \
+            self._conn.execute('UPDATE sandbox SET recovered=1,timestamp=?,upload_id=? WHERE ' \
                                             's3_id=? AND bucket=? AND name=? AND s3_base_path=?',
                         (timestamp.isoformat(), uuid.uuid4().hex, s3_id, bucket, username, s3_path))
 
-            cursor.close()
-
     def sandbox_get_upload(self, s3_id: str, username: str, path: str) -> Optional[tuple]:
         """ Gets the upload associated with the url , user, and upload path
         Arguments:
@@ -270,14 +201,8 @@ class SPDSQLiteSandbox:
                                                                                     'connecting')
 
         # Get all the uploaded files
-        cursor = self._conn.cursor()
-        cursor.execute('SELECT source_path FROM sandbox_files WHERE sandbox_id=? AND ' \
-                                                            'completion_status=2', (sandbox_id,))
-        res = cursor.fetchall()
-
-        cursor.close()
-
-        return res
+        return self._conn.execute('SELECT source_path FROM sandbox_files WHERE sandbox_id=? ' \
+                                            'AND completion_status=2', (sandbox_id,)).fetchall()
 
     def sandbox_new_upload_id(self, upload_id: str) -> Optional[str]:
         """ Returns a newly assigned upload ID
@@ -292,13 +217,24 @@ class SPDSQLiteSandbox:
         # Update the upload ID if requested
         new_upload_id = uuid.uuid4().hex
         with self.transaction():
-            cursor = self._conn.cursor()
-            cursor.execute('UPDATE sandbox SET upload_id=? WHERE upload_id=?',
+            self._conn.execute('UPDATE sandbox SET upload_id=? WHERE upload_id=?',
                                                         (new_upload_id, upload_id))
-            cursor.close()
 
         return new_upload_id
 
+    def __insert_files(self, cursor: sqlite3.Cursor, sandbox_id: int, files: tuple) -> None:
+        """ Adds the files to a sandbox using multi-row INSERT statements
+        Arguments:
+            cursor: the cursor to use
+            sandbox_id: the ID of the sandbox the files belong to
+            files: the list of filenames (or partial paths) to add
+        """
+        files = tuple(files)
+        now_ts = int(time())
+        for start in range(0, len(files), MAX_FILES_PER_INSERT):
+            chunk = files[start:start + MAX_FILES_PER_INSERT]
+            cursor.execute(_insert_files_sql(len(chunk)), (sandbox_id, now_ts) + chunk)
+
     def sandbox_new_upload(self, s3_id: str, username: str, path: str, files: tuple, \
                                             s3_bucket: str, s3_path: str, location_id: str, \
                                             location_name: str, location_lat: float, \
@@ -340,11 +276,7 @@ class SPDSQLiteSandbox:
 
             sandbox_id = cursor.lastrowid
 
-            for one_file in files:
-                cursor.execute('INSERT INTO sandbox_files(sandbox_id, filename, source_path, ' \
-                                                                                    'timestamp) ' \
-                                        'VALUES(?,?,?,strftime("%s", "now"))',
-                                (sandbox_id, one_file, one_file))
+            self.__insert_files(cursor, sandbox_id, files)
 
             cursor.close()
 
@@ -384,7 +316,7 @@ class SPDSQLiteSandbox:
         res = cursor.fetchone()
         cursor.close()
 
-        if not res or len(res) <= 0:
+        if not res:
             return None
 
         sandbox_id = res[0]
@@ -408,7 +340,7 @@ class SPDSQLiteSandbox:
             res = cursor.fetchall()
             cursor.close()
 
-        if not res or len(res) <= 0:
+        if not res:
             return None
 
         return upload_id, [oneFile[0] for oneFile in res]
@@ -450,18 +382,10 @@ class SPDSQLiteSandbox:
 
         # Return the sandbox upload count
         cursor = self._conn.cursor()
-        cursor.execute('WITH '\
-                'upid AS ' \
-                    '(SELECT id FROM sandbox ' \
-                                    'WHERE name=? AND upload_id=? AND path <> ""),' \
-                'uptot AS ' \
-                    '(SELECT sandbox_id,count(1) AS tot FROM sandbox_files,upid WHERE ' \
-                                                                    'sandbox_id=upid.id),' \
-                ' uphave AS ' \
-                    '(SELECT sandbox_id,count(1) AS have FROM sandbox_files,upid WHERE ' \
-                                    'sandbox_id = upid.id AND sandbox_files.completion_status=2)' \
-                'SELECT uptot.tot,uphave.have FROM uptot LEFT JOIN uphave ON '\
-                                                    'uptot.sandbox_id=uphave.sandbox_id LIMIT 1',
+        cursor.execute('SELECT count(1), sum(sandbox_files.completion_status=2) ' \
+                            'FROM sandbox_files JOIN sandbox ON ' \
+                                'sandbox_files.sandbox_id=sandbox.id ' \
+                            'WHERE sandbox.name=? AND sandbox.upload_id=? AND sandbox.path <> ""',
                                                                             (username, upload_id))
 
         res = cursor.fetchone()
@@ -483,18 +407,14 @@ class SPDSQLiteSandbox:
                                                                                 'before connecting')
 
         # Return the list of IDs for files not loaded
-        cursor = self._conn.cursor()
-        cursor.execute('WITH upid AS ' \
+        res = self._conn.execute('WITH upid AS ' \
                     '(SELECT id FROM sandbox ' \
                                     'WHERE name=? AND upload_id=? AND path <> "")' \
                 'SELECT filename FROM sandbox_files, upid WHERE ' \
                                                 'sandbox_id = upid.id AND completion_status = 0',
-                                                                            (username, upload_id))
-
-        res = cursor.fetchall()
-        cursor.close()
+                                                                (username, upload_id)).fetchall()
 
-        if not res or len(res) <= 0:
+        if not res:
             return None
 
         return res
@@ -519,7 +439,7 @@ class SPDSQLiteSandbox:
         res = cursor.fetchone()
         cursor.close()
 
-        if not res or len(res) < 1:
+        if not res:
             return None
 
         sandbox_id = res[0]
@@ -531,11 +451,7 @@ class SPDSQLiteSandbox:
             cursor = self._conn.cursor()
             cursor.execute('DELETE FROM sandbox_files WHERE sandbox_id=?', (sandbox_id, ))
 
-            for one_file in files:
-                cursor.execute('INSERT INTO sandbox_files(sandbox_id, filename, source_path, ' \
-                                                                                'timestamp) ' \
-                                'VALUES(?,?,?,strftime("%s", "now"))',
-                        (sandbox_id, one_file, one_file))
+            self.__insert_files(cursor, sandbox_id, files)
 
             cursor.close()
 
@@ -553,10 +469,9 @@ class SPDSQLiteSandbox:
                                'before connecting')
 
         with self.transaction():
-            cursor = self._conn.cursor()
-            cursor.execute('UPDATE sandbox SET completion_status=? WHERE name=? AND upload_id=?',
+            self._conn.execute('UPDATE sandbox SET completion_status=? WHERE name=? AND ' \
+                                                                                    'upload_id=?',
                            (status, username, upload_id))
-            cursor.close()
 
     def sandbox_upload_complete(self, username: str, upload_id: str) -> None:
         """ Marks the sandbox upload as completed by resetting the path
@@ -570,10 +485,8 @@ class SPDSQLiteSandbox:
 
         # Update the sandbox
         with self.transaction():
-            cursor = self._conn.cursor()
-            cursor.execute('UPDATE sandbox SET path="", recovered=0, completion_status=3 '
+            self._conn.execute('UPDATE sandbox SET path="", recovered=0, completion_status=3 '
                                             'WHERE name=? AND upload_id=?', (username, upload_id))
-            cursor.close()
 
     def sandbox_upload_complete_by_info(self, s3_id: str, username: str, bucket: str, \
                                                                         upload_name: str) -> None:
@@ -590,13 +503,10 @@ class SPDSQLiteSandbox:
 
         # Mark the sandbox as complete
         with self.transaction():
-            cursor = self._conn.cursor()
             query = 'UPDATE sandbox SET path="", recovered=0 WHERE name=? AND s3_id=? AND ' \
                                                                 'bucket=? AND s3_base_path like ?'
             params = (username, s3_id, bucket, '%'+upload_name+'%')
-            cursor.execute(query, params)
-
-            cursor.close()
+            self._conn.execute(query, params)
 
     def sandbox_file_uploaded(self, username: str, upload_id: str, filename: str, \
                                                     mimetype: str, timestamp: str) -> Optional[str]:
@@ -614,25 +524,20 @@ class SPDSQLiteSandbox:
             raise RuntimeError('Attempting to mark file as uploaded in the database ' \
                                                                                 'before connecting')
 
-        # Get the file's ID
+        # Find and update the file in one statement
         sandbox_file_id = None
         with self.transaction():
-            cursor = self._conn.cursor()
-            cursor.execute('SELECT id FROM sandbox_files WHERE '\
-                                'sandbox_files.filename=(?) AND sandbox_id in ' \
-                           '(SELECT id FROM sandbox WHERE name=? AND upload_id=?) LIMIT 1',
-                                                            (filename, username, upload_id))
-
-            res = cursor.fetchall()
-
-            if res and len(res) >= 1 and len(res[0]) >= 1 and res[0][0] is not None:
-                sandbox_file_id = res[0][0]
-
-                cursor.execute('UPDATE sandbox_files SET completion_status=1, mimetype=?, '\
-                                'created_timestamp=? WHERE sandbox_files.filename=? AND id=?',
-                                                (mimetype, timestamp, filename, sandbox_file_id))
-
-            cursor.close()
+            res = self._conn.execute('UPDATE sandbox_files SET completion_status=1, mimetype=?, '\
+                                'created_timestamp=? WHERE id=' \
+                           '(SELECT id FROM sandbox_files WHERE sandbox_files.filename=? AND ' \
+                                'sandbox_id in ' \
+                                '(SELECT id FROM sandbox WHERE name=? AND upload_id=?) LIMIT 1) ' \
+                           'RETURNING id',
+                                        (mimetype, timestamp, filename, username, upload_id)
+                                    ).fetchone()
+
+            if res and res[0] is not None:
+                sandbox_file_id = res[0]
 
         return sandbox_file_id
 
@@ -660,11 +565,10 @@ class SPDSQLiteSandbox:
                            '(SELECT id FROM sandbox WHERE name=? AND upload_id=?) LIMIT 1',
                                                         (original_name, username, upload_id))
 
-            res = cursor.fetchall()
+            res = cursor.fetchone()
 
-            if res and len(res) >= 1 and len(res[0]) >= 2 and res[0][0] is not None:
-                sandbox_file_id = res[0][0]
-                sandbox_source_path = res[0][1]
+            if res and res[0] is not None:
+                sandbox_file_id, sandbox_source_path = res
 
                 # Update the source path
                 idx = sandbox_source_path.index(original_name)
@@ -695,8 +599,8 @@ class SPDSQLiteSandbox:
                                                                     'database before connecting')
 
         if not species and not location:
-            print('INFO: No species or location specified for updating uploaded file ',
-                        f'{file_id}', flush=True)
+            self._logger.info('No species or location specified for updating uploaded file %s',
+                                                                                        file_id)
             self.sandbox_file_processing_complete(file_id)
             return
 
@@ -781,15 +685,9 @@ class SPDSQLiteSandbox:
                                                                                 'before connecting')
 
         # Get the file mime type
-        cursor = self._conn.cursor()
-        cursor.execute('SELECT source_path, mimetype FROM sandbox_files WHERE sandbox_id IN '\
-                        '(SELECT id FROM sandbox WHERE name=? AND upload_id=?)',
-                                                                            (username, upload_id))
-
-        res = cursor.fetchall()
-        cursor.close()
-
-        return res
+        return self._conn.execute('SELECT source_path, mimetype FROM sandbox_files WHERE ' \
+                        'sandbox_id IN (SELECT id FROM sandbox WHERE name=? AND upload_id=?)',
+                                                                (username, upload_id)).fetchall()
 
     def sandbox_file_processing_complete(self, file_id: str) -> None:
         """ Marks the file as fully processed by setting completion_status to 2
@@ -801,9 +699,8 @@ class SPDSQLiteSandbox:
                                'before connecting')
 
         with self.transaction():
-            cursor = self._conn.cursor()
-            cursor.execute('UPDATE sandbox_files SET completion_status=2 WHERE id=?', (file_id,))
-            cursor.close()
+            self._conn.execute('UPDATE sandbox_files SET completion_status=2 WHERE id=?',
+                                                                                    (file_id,))
 
     def get_file_created_timestamp(self, username: str, upload_id: str) -> Optional[tuple]:
         """ Returns the file paths and created timestamp for an upload
@@ -829,21 +726,23 @@ class SPDSQLiteSandbox:
         return res
 
 
-    def get_file_species(self, username: str, upload_id: str) -> Optional[tuple]:
+    def get_file_species(self, username: str, upload_id: str) -> Iterator[tuple]:
         """ Returns the file species information for an upload
         Arguments:
             username: the name of the person starting the upload
             upload_id: the ID of the upload
         Return:
-            Returns a tuple containing a tuple for each species entry of the upload. Each row
+            Returns an iterator with a tuple for each species entry of the upload. Each row
             tuple has the filename, timestamp, scientific name, count, common name, and location id
+        Notes:
+            The rows are fetched as they're iterated over, so they need to be consumed before
+            the connection is closed
         """
         if self._conn is None:
             raise RuntimeError('Attempting to get upload mimetypes from the database '\
                                                                                 'before connecting')
 
         # Return the files species
-        cursor = self._conn.cursor()
         query = \
             'WITH loc AS (SELECT id, location_id as loc_id ' \
                                                 'FROM sandbox WHERE name=? AND upload_id=?),' \
@@ -853,12 +752,7 @@ class SPDSQLiteSandbox:
                                                             'ssp.obs_scientific, ssp.obs_count ' \
                             'FROM sandbox_species ssp, files WHERE ssp.sandbox_file_id=files.id'
 
-        cursor.execute(query, (username, upload_id))
-
-        res = cursor.fetchall()
-        cursor.close()
-
-        return res
+        return self._conn.execute(query, (username, upload_id))
 
     def sandbox_get_completion_status(self, username: str, upload_id: str) -> Optional[int]:
         """ Returns the completion status of the sandbox upload
@@ -878,7 +772,7 @@ class SPDSQLiteSandbox:
         res = cursor.fetchone()
         cursor.close()
 
-        if not res or len(res) < 1:
+        if not res:
             return None
 
         return res[0]
@@ -0,0 +1,50 @@
+"""This script contains testing of the SQLite database helper functions
+"""
+
+import sys
+
+from spd_database.spdsqlite import _prefix_end
+
+# The largest character, which can't be incremented
+MAX_CHAR = chr(sys.maxunicode)
+
+
+def test_prefix_end() -> None:
+    """ Tests getting the upper bound of a prefix search
+    """
+    test_data = [['Uploads/2024', 'Uploads/2025'],
+                 ['a', 'b'],
+                 ['path/', 'path0'],
+                 # Characters that can't be incremented are dropped
+                 ['ab' + MAX_CHAR, 'ac'],
+                 ['a' + MAX_CHAR + MAX_CHAR, 'b'],
+                 # The surrogates aren't valid characters and are skipped
+                 ['x\ud7ff', 'x\ue000'],
+                 # There's no upper bound when nothing can be incremented
+                 ['', None],
+                 [MAX_CHAR, None],
+                 [MAX_CHAR + MAX_CHAR, None]]
+
+    for idx, (prefix, answer) in enumerate(test_data):
+        print(f'test_prefix_end: test index {idx}', flush=True)
+        assert _prefix_end(prefix) == answer
+
+
+def test_prefix_end_range() -> None:
+    """ Tests which strings fall inside the search range of a prefix
+    """
+    test_data = [['Uploads/2024', ['Uploads/2024', 'Uploads/2024/a.jpg', 'Uploads/2024' + MAX_CHAR],
+                                  ['Uploads/2023/a.jpg', 'Uploads/2025', 'uploads/2024/a.jpg']],
+                 ['x\ud7ff', ['x\ud7ff', 'x\ud7ffz', 'x\ud7ff' + MAX_CHAR],
+                             ['x\ue000', 'y']],
+                 ['a' + MAX_CHAR, ['a' + MAX_CHAR, 'a' + MAX_CHAR + 'z'],
+                                  ['a', 'b']]]
+
+    for idx, (prefix, matches, non_matches) in enumerate(test_data):
+        print(f'test_prefix_end_range: test index {idx}', flush=True)
+        end = _prefix_end(prefix)
+        for one_match in matches:
+            assert prefix <= one_match < end
+        # Matching is case-sensitive, unlike a LIKE pattern
+        for one_non_match in non_matches:
+            assert not prefix <= one_non_match < end